@@ -1,4 +1,6 @@
+import multiprocessing
 from archivviewer import main
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -6,7 +6,7 @@ block_cipher = None
 a = Analysis(['ArchivViewer.py'],
              pathex=['H:\\Git Repos\\ArchivViewer'],
              binaries=[('archivviewer/icon128.png', 'archivviewer')],
-             datas=[('LICENSE.txt', '.')],
+             datas=[('LICENSE.txt', '.'), ('archivviewer/unoservice.py', 'archivviewer')],
              hiddenimports=['libjpeg', 'pylibjpeg'],
              hookspath=[],
              runtime_hooks=[],
@@ -0,0 +1,578 @@
+# ArchiveConverter.py
+
+import io, logging, email, subprocess, os, tempfile, shutil, threading, time
+from contextlib import contextmanager
+from pathlib import Path
+from .LhaStream import LhaArchive
+import img2pdf
+import libjpeg
+from PIL import Image, ImageFile
+import PIL
+from PyPDF2 import PdfFileMerger
+from subprocess import PIPE
+from .OfficeConverter import OfficeConverterError, OfficeConverterTimeout, OfficeConverterUnavailable
+from .PartStore import PartStore
+
+LOGGER = logging.getLogger(__name__)
+
+@contextmanager
+def tempdir(prefix='tmp'):
+    """A context manager for creating and then deleting a temporary directory."""
+    tmpdir = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _noop(*args):
+    pass
+
+OFFICE_EXTENSIONS = ('.odt', '.ods')
+# seconds per file a LibreOffice batch run may take before it is killed
+OFFICE_BATCH_TIMEOUT = 60
+# the same for GIMP, per TIFF file of a run
+GIMP_TIMEOUT = 60
+
+IMAGE_SIGNATURES = (bytes.fromhex('FFD8'), b'\x89PNG', b'II*\x00', b'MM\x00*', b'GIF8', b'BM', bytes.fromhex('0000000C6A502020'))
+
+# A4 at 300 dpi
+A4_PIXELS = (2480, 3508)
+
+def fitSize(size, bounds):
+    """Returns size scaled down to fit into bounds, keeping the aspect ratio."""
+    scale = min(bounds[0] / size[0], bounds[1] / size[1], 1)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+def draftSize(size, bounds):
+    """Returns the size to request from Image.draft() to fit into bounds or None
+    if draft mode would not help. The JPEG decoder only scales by powers of two,
+    so the image has to be at least twice the target size."""
+    target = fitSize(size, bounds)
+    if size[0] >= 2 * target[0] and size[1] >= 2 * target[1]:
+        return target
+    return None
+
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*')
+# TIFF compressions (as named by PIL) img2pdf embeds as they are (CCITT) or
+# stores losslessly at no loss in size (uncompressed). It would re-encode LZW
+# or JPEG compressed pages as Flate, often several times the size.
+IMG2PDF_TIFF_COMPRESSIONS = frozenset(('raw', 'tiff_ccitt', 'group3', 'group4'))
+
+def tiffCompressions(content):
+    """Returns the set of compressions used by the pages of a TIFF file."""
+    compressions = set()
+    with Image.open(io.BytesIO(content)) as img:
+        for frame in range(getattr(img, 'n_frames', 1)):
+            img.seek(frame)
+            compressions.add(img.info.get('compression', 'raw'))
+    return compressions
+
+def gimpScript(infile, outfile):
+    """Script-Fu call converting infile to the PDF file outfile."""
+    return '(let* ((image (car (gimp-file-load RUN-NONINTERACTIVE "{infile}" "{infile}")))(drawable (car (gimp-image-get-active-layer image))))\
+        (file-pdf-save2 RUN-NONINTERACTIVE image drawable "{outfile}" "{outfile}" FALSE TRUE TRUE TRUE FALSE)(gimp-image-delete image))'.format(infile=infile.replace('\\', '\\\\'), outfile=outfile.replace('\\', '\\\\'))
+
+def isImage(content):
+    return content.startswith(IMAGE_SIGNATURES)
+
+def isOfficeDocument(content, extension):
+    return content[0:5] == b'{\\rtf' or (content[0:4] == bytes.fromhex('504B0304') and extension in OFFICE_EXTENSIONS)
+
+class ArchiveConverter:
+    """Converts the LHA archive of a single ARCHIV entry into one PDF file.
+
+    Instances only carry plain settings so that they can be handed to worker
+    processes. Progress and cancellation hooks and the office conversion service
+    are optional and are not pickled. Converted parts are looked up in and added
+    to the part store, if one is given."""
+    
+    def __init__(self, tmpdir, librepath, gimppath, options, isolatedProfile = False, partStore = None):
+        self._tmpdir = tmpdir
+        self._librepath = librepath
+        self._gimppath = gimppath
+        self._options = dict(options)
+        self._isolatedProfile = isolatedProfile
+        self.parts = partStore
+        self.office = None
+        self.setCallbacks()
+    
+    def setCallbacks(self, status = _noop, initGenerate = _noop, progress = _noop, checkCancelled = _noop):
+        self.status = status
+        self.initGenerate = initGenerate
+        self.progress = progress
+        self.checkCancelled = checkCancelled
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for cb in ('status', 'initGenerate', 'progress', 'checkCancelled', 'office'):
+            del state[cb]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.office = None
+        self.setCallbacks()
+    
+    def _officeProfileArgs(self):
+        # concurrent LibreOffice instances must not share a user profile
+        if not self._isolatedProfile:
+            return []
+        profile = Path(self._tmpdir, 'soffice-profile-{}'.format(os.getpid())).as_uri()
+        return ['-env:UserInstallation={}'.format(profile)]
+    
+    def _useOfficeService(self):
+        # without a running service every conversion starts LibreOffice on its own
+        return self.office is not None and self.office.available()
+    
+    def _convertOffice(self, file, content, extension, collectedErrors):
+        with tempdir() as tmpdir:
+            tmpfile = os.sep.join([tmpdir, "temp" + extension])
+            pdffile = os.sep.join([tmpdir, "temp.pdf"])
+            with open(tmpfile, "wb") as f:
+                f.write(content)
+            converted = False
+            if self._useOfficeService():
+                try:
+                    self.office.convert(tmpfile, pdffile)
+                    converted = True
+                except OfficeConverterUnavailable as e:
+                    LOGGER.info("{}, converting with LibreOffice directly".format(e))
+                except OfficeConverterError as e:
+                    err = "%s: %s" % (file['beschreibung'], e)
+                    collectedErrors.append(err)
+                    return None
+            if not converted:
+                command = '"'+" ".join(['"'+self._librepath+'"', *[ '"'+arg+'"' for arg in self._officeProfileArgs() ], "--convert-to pdf", "--outdir", '"'+tmpdir+'"', '"'+tmpfile+'"'])+'"'
+                if os.system(command) != 0:
+                    err = "%s: Fehler beim Ausführen des Kommandos: '%s'" % (file['beschreibung'], command)
+                    collectedErrors.append(err)
+                    return None
+            try:
+                with open(pdffile, "rb") as f:
+                    return f.read()
+            except:
+                err = "%s: Fehler beim Öffnen der konvertierten PDF-Datei '%s' (konvertiert aus '%s')" % (file['beschreibung'], pdffile, tmpfile)
+                collectedErrors.append(err)
+                return None
+    
+    def useGimpForAllTiffs(self):
+        return self._gimppath is not None and self._options['useGimpForTiff'] and self._options.get('gimpForAllTiffs', False)
+    
+    def extractParts(self, file, ios, outdir, office = True, tiff = False):
+        """Writes the office format members and, if tiff is set, the TIFF members of
+        the archive to outdir for batch conversion. Returns two dicts mapping the
+        member index to the written file, one for office documents and one for TIFFs."""
+        officeParts = {}
+        tiffParts = {}
+        for (index, member) in enumerate(LhaArchive(ios)):
+            _, extension = os.path.splitext(member.name)
+            head = member.peek()
+            if office and isOfficeDocument(head, extension):
+                if extension == '':
+                    extension = '.rtf'
+                parts = officeParts
+            elif tiff and head[0:4] in TIFF_SIGNATURES:
+                extension = '.tif'
+                parts = tiffParts
+            else:
+                continue
+            partfile = os.sep.join([outdir, '{}_{}{}'.format(file["id"], index, extension)])
+            with open(partfile, 'wb') as f:
+                member.extract(f)
+            parts[index] = partfile
+        
+        return officeParts, tiffParts
+    
+    def convertOfficeBatch(self, infiles, outdir, chunksize = 50):
+        """Converts all infiles to PDF files in outdir, using one LibreOffice run per
+        chunk of files or through the office service. Returns a dict mapping each
+        successfully converted input file to its PDF file and the input files which
+        timed out to None, they are not worth converting once more."""
+        results = {}
+        if self._librepath is None:
+            return results
+        
+        for start in range(0, len(infiles), chunksize):
+            self.checkCancelled()
+            chunk = infiles[start:start+chunksize]
+            if self._useOfficeService():
+                for (position, infile) in enumerate(chunk):
+                    pdffile = os.sep.join([outdir, os.path.splitext(os.path.basename(infile))[0] + '.pdf'])
+                    try:
+                        self.office.convert(infile, pdffile, timeout = OFFICE_BATCH_TIMEOUT)
+                    except OfficeConverterUnavailable as e:
+                        # the rest of the chunk is converted by a LibreOffice run below
+                        LOGGER.info("{}, converting with LibreOffice directly".format(e))
+                        chunk = chunk[position:]
+                        break
+                    except OfficeConverterTimeout as e:
+                        LOGGER.debug("Batch conversion of '{}' timed out: {}".format(infile, e))
+                        results[infile] = None
+                        continue
+                    except OfficeConverterError as e:
+                        LOGGER.debug("Batch conversion of '{}' failed: {}".format(infile, e))
+                        continue
+                    if os.path.isfile(pdffile):
+                        results[infile] = pdffile
+                else:
+                    continue
+            
+            command = [ self._librepath, *self._officeProfileArgs(), '--convert-to', 'pdf', '--outdir', outdir, *chunk ]
+            try:
+                subprocess.run(command, stdout=PIPE, stderr=PIPE, timeout = OFFICE_BATCH_TIMEOUT * len(chunk))
+            except subprocess.TimeoutExpired:
+                # e.g. LibreOffice stuck on a broken document, output of the run is not trusted
+                LOGGER.debug("Batch conversion of {} files timed out".format(len(chunk)))
+                for infile in chunk:
+                    results[infile] = None
+                continue
+            except OSError as e:
+                LOGGER.debug("Batch conversion failed: {}".format(e))
+                return results
+            for infile in chunk:
+                pdffile = os.sep.join([outdir, os.path.splitext(os.path.basename(infile))[0] + '.pdf'])
+                if os.path.isfile(pdffile):
+                    results[infile] = pdffile
+        
+        return results
+    
+    def convertGimpBatch(self, infiles, outdir, maxCommandLength = 30000):
+        """Converts all infiles to PDF files in outdir in as few GIMP sessions as the
+        command line length allows, with one Script-Fu call per file. Returns the
+        manifest: a dict mapping each successfully converted input file to its PDF file.
+        The files of a session which timed out are left out and thus converted one
+        by one later on."""
+        manifest = {}
+        if self._gimppath is None:
+            return manifest
+        
+        pending = []
+        for infile in infiles:
+            pending.append((infile, os.sep.join([outdir, os.path.splitext(os.path.basename(infile))[0] + '.pdf'])))
+        
+        while len(pending) > 0:
+            self.checkCancelled()
+            chunk = []
+            commands = []
+            length = len(subprocess.list2cmdline([ self._gimppath, '-i', '-b', '(gimp-quit 0)' ]))
+            while len(pending) > 0:
+                script = gimpScript(*pending[0])
+                scriptLength = len(subprocess.list2cmdline([ '-b', script ])) + 1
+                if len(commands) > 0 and length + scriptLength > maxCommandLength:
+                    break
+                chunk.append(pending.pop(0))
+                commands.extend([ '-b', script ])
+                length += scriptLength
+            
+            try:
+                self._runGimp([ self._gimppath, '-i', *commands, '-b', '(gimp-quit 0)' ], GIMP_TIMEOUT * len(chunk))
+            except subprocess.TimeoutExpired:
+                # e.g. GIMP stuck on a broken TIFF, output of the session is not trusted
+                LOGGER.debug("GIMP batch conversion of {} files timed out".format(len(chunk)))
+                continue
+            except OSError as e:
+                LOGGER.debug("GIMP batch conversion failed: {}".format(e))
+                return manifest
+            for (infile, outfile) in chunk:
+                if os.path.isfile(outfile):
+                    manifest[infile] = outfile
+        
+        return manifest
+    
+    def _layoutFun(self):
+        if self._options['fitToA4']:
+            return img2pdf.get_layout_fun((img2pdf.mm_to_pt(210), img2pdf.mm_to_pt(297)))
+        # like the PIL path: scans often lack a DPI header or claim 72 dpi, which
+        # would blow a page up to several times A4
+        return img2pdf.get_fixed_dpi_layout_fun((300, 300))
+    
+    def _jpegToPdf(self, content):
+        """Embeds the JPEG data into the PDF as it is, without decoding or re-encoding.
+        Files img2pdf cannot pass through (e.g. lossless JPEG) are decoded instead."""
+        try:
+            return io.BytesIO(img2pdf.convert(content, layout_fun = self._layoutFun()))
+        except Exception as e:
+            LOGGER.debug("JPEG passthrough not possible ({}), decoding the image".format(e))
+            return self._imageToPdf(content)
+    
+    def _tiffToPdf(self, content):
+        """Converts all pages of a TIFF file in-process. CCITT G4 pages are embedded
+        without re-encoding and uncompressed ones stored losslessly by img2pdf;
+        files with other compressions, e.g. JPEG scans, are converted by PIL."""
+        compressions = tiffCompressions(content)
+        if not compressions <= IMG2PDF_TIFF_COMPRESSIONS:
+            LOGGER.debug("TIFF compression {} is not passed through, using PIL".format(', '.join(sorted(compressions))))
+            return self._imageToPdf(content)
+        return io.BytesIO(img2pdf.convert(content, layout_fun = self._layoutFun()))
+    
+    def _gimpToPdf(self, file, content, attcounter, cleanupfiles):
+        tiffile = os.sep.join([self._tmpdir, '{}.{}.tif'.format(file["id"], attcounter)])
+        outfile = os.sep.join([self._tmpdir, '{}.{}.pdf'.format(file["id"], attcounter)])
+        cleanupfiles.append(tiffile)
+        cleanupfiles.append(outfile)
+        with open(tiffile, 'wb') as f:
+            f.write(content)
+        returncode = self._runGimp([self._gimppath, '-i', '-b', gimpScript(tiffile, outfile), '-b', '(gimp-quit 0)'], GIMP_TIMEOUT)
+        if returncode != 0:
+            raise Exception("GIMP wurde mit Fehlercode {} beendet".format(returncode))
+        
+        return outfile
+    
+    def _runGimp(self, command, timeout):
+        """Runs GIMP, checking for cancellation while it runs. Kills it and raises
+        subprocess.TimeoutExpired after timeout seconds. Returns the exit code."""
+        deadline = time.monotonic() + timeout
+        process = subprocess.Popen(command, stdout=PIPE, stderr=PIPE)
+        try:
+            while True:
+                try:
+                    stdout, stderr = process.communicate(timeout = 0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    self.checkCancelled()
+                    if time.monotonic() > deadline:
+                        raise subprocess.TimeoutExpired(command, timeout)
+        except:
+            process.kill()
+            process.communicate()
+            raise
+        LOGGER.debug("GIMP output: {} {}".format(stdout, stderr))
+        
+        return process.returncode
+    
+    def _imageToPdf(self, content):
+        inbuffer = io.BytesIO(content)
+        try:
+            img = Image.open(inbuffer)
+            if self._options['fitToA4'] and draftSize(img.size, A4_PIXELS) is not None:
+                # let the JPEG decoder scale down large scans while decoding
+                img.draft(img.mode, draftSize(img.size, A4_PIXELS))
+            img.load()
+        except OSError as e:
+            LOGGER.debug("Failed: {}. Trying libjpeg now for lossless compressed JPEG file.".format(e))
+            img = Image.fromarray(libjpeg.decode(content))
+        if self._options['fitToA4']:
+            twidth, theight = A4_PIXELS
+            cwidth, cheight = img.size
+            if cwidth > twidth or cheight > theight:
+                img = img.resize(fitSize(img.size, A4_PIXELS), resample = PIL.Image.LANCZOS)
+            elif cwidth < twidth and cheight < theight:
+                nimg = Image.new('RGB', (twidth, theight), color = 'white')
+                nimg.paste(img, (round((twidth-cwidth)/2), round((theight-cheight)/2)))
+                img = nimg
+        outbuffer = io.BytesIO()
+        # save_all keeps all pages of multi-page images
+        img.save(outbuffer, 'PDF', resolution=300, save_all=True)
+        outbuffer.seek(0)
+        return outbuffer
+    
+    def _convertImage(self, file, name, content, attcounter, cleanupfiles):
+        head = content[0:4]
+        if head in TIFF_SIGNATURES and self.useGimpForAllTiffs():
+            return self._gimpToPdf(file, content, attcounter, cleanupfiles)
+        elif head in TIFF_SIGNATURES:
+            try:
+                return self._tiffToPdf(content)
+            except Exception as e:
+                if self._gimppath is not None and self._options['useGimpForTiff']:
+                    LOGGER.debug("{}: {}: TIFF conversion failed ({}), export via GIMP at '{}'".format(file["beschreibung"], name, e, self._gimppath))
+                    return self._gimpToPdf(file, content, attcounter, cleanupfiles)
+                LOGGER.debug("{}: {}: TIFF conversion failed ({}), using PIL".format(file["beschreibung"], name, e))
+                return self._imageToPdf(content)
+        elif self._options['useImg2pdf']:
+            LOGGER.debug("Using PIL for file conversion")
+            return self._imageToPdf(content)
+        elif head[0:2] == bytes.fromhex('FFD8'):
+            return self._jpegToPdf(content)
+        else:
+            LOGGER.debug("Using img2pdf for file conversion")
+            return io.BytesIO(img2pdf.convert(content, layout_fun = self._layoutFun()))
+    
+    def partKey(self, content):
+        """Part store key for the source data content or None without a store."""
+        if self.parts is None:
+            return None
+        return PartStore.key(content, self._options)
+    
+    def _storedPart(self, content, convert, stats):
+        """Returns the PDF converted from content as a file object, taken from the
+        part store if the same data has been converted before. convert(content) may
+        return the PDF as bytes, as a file object or as a file name, or None on
+        failure."""
+        key = self.partKey(content)
+        if key is not None:
+            data = self.parts.get(key)
+            if data is not None:
+                stats['dedupeHits'] = stats.get('dedupeHits', 0) + 1
+                stats['dedupeBytes'] = stats.get('dedupeBytes', 0) + len(data)
+                return io.BytesIO(data)
+        
+        data = convert(content)
+        if data is None:
+            return None
+        elif isinstance(data, str):
+            with open(data, 'rb') as f:
+                data = f.read()
+        elif not isinstance(data, bytes):
+            data = data.read()
+        if key is not None:
+            self.parts.put(key, data)
+        
+        return io.BytesIO(data)
+    
+    def _spool(self, member, spools):
+        """Decompresses member into a temporary file which stays in memory unless it
+        is large. The file is kept open until the merger has been written."""
+        spool = tempfile.SpooledTemporaryFile(max_size = 8*1024*1024, dir = self._tmpdir)
+        spools.append(spool)
+        member.extract(spool)
+        spool.seek(0)
+        return spool
+    
+    def convert(self, file, ios, filename, collectedErrors, cleanupfiles, convertedParts = None, stats = None):
+        merger = PdfFileMerger()
+        if stats is None:
+            stats = {}
+        
+        self.checkCancelled()
+        self.status("Öffne Archivdatei...")
+        archive = LhaArchive(ios)
+        
+        appended = False
+        
+        attcounter = 0
+        spools = []
+        
+        self.initGenerate(len(archive))
+        
+        for (index, member) in enumerate(archive):
+            self.checkCancelled()
+            self.progress()
+            name = member.name
+            if convertedParts is not None and index in convertedParts:
+                if convertedParts[index] is None:
+                    collectedErrors.append("%s: Zeitüberschreitung bei der Konvertierung von '%s'" % (file['beschreibung'], name))
+                    continue
+                # converted in a batch before, the member is not even decompressed
+                with open(convertedParts[index], "rb") as f:
+                    merger.append(io.BytesIO(f.read()))
+                appended = True
+                continue
+            head = member.peek()
+            _, extension = os.path.splitext(name)
+            if head[0:5] == b'%PDF-':                  
+                merger.append(self._spool(member, spools))
+                appended = True
+            elif isOfficeDocument(head, extension):
+                if self._librepath is not None:
+                    pdfcontent = self._storedPart(member.read(), lambda content: self._convertOffice(file, content, extension, collectedErrors), stats)
+                    if pdfcontent is not None:
+                        merger.append(pdfcontent)
+                        appended = True
+                else:
+                    err = "%s: Die Konvertierung nach PDF ist nicht möglich, da keine LibreOffice-Installation gefunden wurde" % (file['beschreibung'])
+                    collectedErrors.append(err)
+            elif name == "message.eml":
+                # eArztbrief
+                eml = email.message_from_binary_file(self._spool(member, spools))
+                errors = []                    
+                for part in eml.get_payload():
+                    self.checkCancelled()
+                    fnam = part.get_filename()
+                    partcont = part.get_payload(decode=True)
+                    if partcont[0:5] == b'%PDF-':
+                        merger.append(io.BytesIO(partcont))
+                        appended = True
+                    elif isImage(partcont):
+                        try:
+                            merger.append(self._storedPart(partcont, lambda content: self._convertImage(file, fnam, content, attcounter, cleanupfiles), stats))
+                            attcounter += 1
+                            appended = True
+                        except Exception as e:
+                            errors.append("%s: eArztbrief: Anhang '%s' konnte nicht konvertiert werden (%s)" % (file["beschreibung"], fnam, e))
+                    else:
+                        errors.append("%s: eArztbrief: nicht unterstütztes Anhangsformat in Anhang '%s'" % (file["beschreibung"], fnam))
+                
+                if not appended and len(errors) > 0:
+                    err = '\n'.join(errors)
+                    collectedErrors.append(err)
+            elif not isImage(head):
+                # not worth decompressing
+                err = "%s: Dateiinhalt '%s' ist kein unterstützter Dateityp -> wird nicht an PDF angehängt" % (file["beschreibung"], name)
+                LOGGER.debug(err)
+                collectedErrors.append(err)
+            else:
+                try:
+                    merger.append(self._storedPart(member.read(), lambda content: self._convertImage(file, name, content, attcounter, cleanupfiles), stats))
+                    attcounter += 1
+                    appended = True
+                except Exception as e:
+                    err = "%s: Dateiinhalt '%s' ist kein unterstützter Dateityp -> wird nicht an PDF angehängt (%s)" % (file["beschreibung"], name, e)
+                    LOGGER.debug(err)
+                    collectedErrors.append(err)
+        
+        self.checkCancelled()
+        if appended:
+            try:
+                # the output is visible under its final name only once it is complete,
+                # other workers may be waiting for the same document
+                partfile = '{}.{}.{}.part'.format(filename, os.getpid(), threading.get_ident())
+                merger.write(partfile)
+                os.replace(partfile, filename)
+            except Exception as e:
+                err = "{}: Fehler beim Schreiben der Ausgabedatei '{}': {}".format(file["beschreibung"], filename, e)
+                collectedErrors.append(err)
+                filename = None
+        else:
+            filename = None
+            blobfilename = os.sep.join([self._tmpdir, '{}.blb'.format(file["id"])])
+            ios.seek(0)
+            with open(blobfilename, 'wb') as f:
+                shutil.copyfileobj(ios, f)
+            err = "Ein Abzug des Blobinhalts wurde nach '{}' geschrieben. Er ist dort bis zum Programmende verfügbar.".format(blobfilename)
+            collectedErrors.append(err)
+            
+        merger.close()
+        for spool in spools:
+            spool.close()
+        return filename
+
+
+class ConversionCancelledError(Exception):
+    pass
+
+# set up in every process of the export pool by initConversionProcess
+_progressQueue = None
+_cancelEvent = None
+
+def initConversionProcess(progressQueue, cancelEvent):
+    """Process pool initializer. Conversions report their progress to progressQueue
+    as (parts, partsDone) increments and stop between parts once cancelEvent is set."""
+    global _progressQueue, _cancelEvent
+    _progressQueue = progressQueue
+    _cancelEvent = cancelEvent
+
+def _checkCancelled():
+    if _cancelEvent is not None and _cancelEvent.is_set():
+        raise ConversionCancelledError()
+
+def convertBlobFile(converter, file, blobfile, filename, convertedParts = None):
+    """Process pool entry point: convert the blob stored in blobfile to filename.
+    Returns the output file, the errors and the part store statistics."""
+    collectedErrors = []
+    cleanupfiles = []
+    stats = {}
+    if _progressQueue is not None:
+        converter.setCallbacks(initGenerate = lambda count: _progressQueue.put((count, 0)), progress = lambda: _progressQueue.put((0, 1)),
+            checkCancelled = _checkCancelled)
+    try:
+        with open(blobfile, 'rb') as ios:
+            filename = converter.convert(file, ios, filename, collectedErrors, cleanupfiles, convertedParts, stats)
+    finally:
+        for f in cleanupfiles:
+            try:
+                os.unlink(f)
+            except:
+                pass
+    
+    return (filename, collectedErrors, stats)
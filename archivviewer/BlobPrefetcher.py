@@ -0,0 +1,185 @@
+# BlobPrefetcher.py
+
+import os, logging, hashlib, threading
+from collections import deque
+from .PdfCache import blobFingerprint
+from .ConnectionPool import ConnectionPool
+
+LOGGER = logging.getLogger(__name__)
+
+def _noop(*args):
+    pass
+
+def streamBlob(datei, out, chunksize = 256*1024, checkCancelled = _noop):
+    """Copies the FDATEI value datei, a stream blob or bytes, to the file object out
+    in chunks. Returns the fingerprint of the blob."""
+    digest = hashlib.sha1()
+    length = 0
+    if hasattr(datei, 'read'):
+        while True:
+            checkCancelled()
+            chunk = datei.read(chunksize)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            length += len(chunk)
+        try:
+            datei.close()
+        except:
+            pass
+    else:
+        digest.update(datei)
+        out.write(datei)
+        length = len(datei)
+    out.flush()
+    out.seek(0)
+
+    return blobFingerprint(length, digest.hexdigest())
+
+class _Stopped(Exception):
+    pass
+
+class BlobPrefetcher:
+    """Fetches the blobs of an export ahead of the prepare stage.
+
+    The blobs are requested in chunks of IN (...) queries per database instead of
+    one query per document, on a thread of its own with connections checked out
+    from the pools. Every blob is streamed to the file given by destination(file).
+    Iterating yields (index, database, fingerprint) in the order the blobs arrive;
+    the fingerprint is None for a document which is missing from the database.
+
+    Fetching pauses as soon as maxBytes of blobs wait for the consumer. A blob
+    counts until the consumer asks for the next one, so a single blob larger than
+    the limit still gets through. The limit only covers how far fetching runs ahead
+    of the consumer, blob files the consumer keeps afterwards are its business."""
+
+    def __init__(self, pools, files, destination, chunkSize = 50, maxBytes = 64*1024*1024):
+        self._pools = pools
+        self._files = files
+        self._destination = destination
+        self._chunkSize = max(1, chunkSize)
+        self._maxBytes = maxBytes
+        self._available = threading.Condition()
+        self._queue = deque()
+        self._inflight = 0
+        self._consumed = 0
+        self._done = False
+        self._stopped = False
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, name = "BlobPrefetcher", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops fetching and removes the blob files which have not been consumed."""
+        with self._available:
+            self._stopped = True
+            self._available.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        for (index, _, _, _) in self._queue:
+            try:
+                os.unlink(self._destination(self._files[index]))
+            except OSError:
+                pass
+        self._queue.clear()
+
+    def __iter__(self):
+        while True:
+            with self._available:
+                self._inflight -= self._consumed
+                self._consumed = 0
+                self._available.notify_all()
+                while len(self._queue) == 0 and not self._done:
+                    self._available.wait()
+                if len(self._queue) == 0:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                (index, database, fingerprint, size) = self._queue.popleft()
+                self._consumed = size
+            yield (index, database, fingerprint)
+
+    def _checkStopped(self):
+        if self._stopped:
+            raise _Stopped()
+
+    def _run(self):
+        try:
+            pending = { database: [] for database in self._pools }
+            for (index, file) in enumerate(self._files):
+                database = 'MEDOFFARC' if 'medoffarc' in file else 'MEDOFF'
+                pending[database].append(index)
+                if len(pending[database]) == self._chunkSize:
+                    self._fetchChunk(database, pending[database])
+                    pending[database] = []
+            for (database, indices) in pending.items():
+                if len(indices) > 0:
+                    self._fetchChunk(database, indices)
+        except _Stopped:
+            pass
+        except Exception as e:
+            LOGGER.debug("Prefetching blobs failed: {}".format(e))
+            self._error = e
+        finally:
+            with self._available:
+                self._done = True
+                self._available.notify_all()
+
+    def _fetchChunk(self, database, indices):
+        byId = {}
+        for index in indices:
+            byId.setdefault(self._files[index]["id"], []).append(index)
+        try:
+            self._query(database, byId)
+        except Exception as e:
+            if not ConnectionPool.isDatabaseError(e):
+                raise
+            # the pool has dropped the broken connection, fetch the rest once more
+            LOGGER.info("Fetching blobs from {} failed ({}), reconnecting".format(database, e))
+            self._query(database, byId)
+        if len(byId) > 0:
+            # reported per document, the rest of the export goes on
+            with self._available:
+                for indices in byId.values():
+                    for index in indices:
+                        self._queue.append((index, database, None, 0))
+                self._available.notify_all()
+
+    def _query(self, database, byId):
+        """Fetches the blobs of the documents in byId, delivered ones are removed from it."""
+        ids = list(byId.keys())
+        selectStm = "SELECT a.FSUROGAT, a.FDATEI FROM ARCHIV a WHERE a.FSUROGAT IN ({})".format(', '.join([ '?' ] * len(ids)))
+        with self._pools[database].connection() as con:
+            cur = con.cursor()
+            cur.set_stream_blob('FDATEI')
+            cur.execute(selectStm, ids)
+            for (surogat, datei) in cur:
+                with self._available:
+                    while self._inflight >= self._maxBytes and not self._stopped:
+                        self._available.wait()
+                self._checkStopped()
+                indices = byId.pop(surogat, [])
+                if len(indices) == 0:
+                    continue
+                blobfile = self._destination(self._files[indices[0]])
+                try:
+                    with open(blobfile, 'wb') as out:
+                        fingerprint = streamBlob(datei, out, checkCancelled = self._checkStopped)
+                        size = os.fstat(out.fileno()).st_size
+                except:
+                    try:
+                        os.unlink(blobfile)
+                    except OSError:
+                        pass
+                    raise
+                with self._available:
+                    for index in indices:
+                        self._queue.append((index, database, fingerprint, size))
+                        self._inflight += size
+                        size = 0
+                    self._available.notify_all()
+            cur.close()
@@ -1,19 +1,30 @@
 # CategoryModel.py
 
-import io, struct, os, sys, logging
-from PyQt5.QtCore import QAbstractListModel, QMutex, Qt
+import io, struct, os, sys, logging, hashlib, pickle
+from PyQt5.QtCore import QAbstractListModel, QMutex, Qt, QItemSelection, QItemSelectionRange
 from PyQt5.QtGui import QBrush, QColor
 from contextlib import contextmanager
 from collections import OrderedDict
 from itertools import islice
+from .MemoParser import MOMask, parse_memo_blob, parse_briefe_blob
+from .configreader import ConfigReader
 
 LOGGER = logging.getLogger(__name__)
 
-class MOMask:
-    NOTUSECATEGORY = 0b00001000
-    DAYPROTOCOL = 0b00000100
-    AUTOSEND = 0b00000001
-    EMERGENCYSEND = 0b00000010
+# bump when the parsed catalog changes its layout
+CATALOG_VERSION = 1
+
+def catalogFingerprint(blobs):
+    sha1 = hashlib.sha1(str(CATALOG_VERSION).encode('ascii'))
+    for blob in blobs:
+        if blob is None:
+            blob = b''
+        elif isinstance(blob, str):
+            blob = blob.encode('utf-8')
+        sha1.update(len(blob).to_bytes(8, 'little'))
+        sha1.update(blob)
+    
+    return sha1.hexdigest()
 
 class ExceptionBytesIO(io.BytesIO):
     def __init__(self, buffer = None):
@@ -26,145 +37,37 @@ class ExceptionBytesIO(io.BytesIO):
         
         return res
 
-def parse_memo_blob(blob):
-    categories = {}
-    offset = 0
-    totallen = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    b1len = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2 + b1len
-    b2len = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2+ b2len
-    b3len = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2+ b3len
-    b4len = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2 + b4len
-    b5len = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2 + b5len
-    #b6len = int.from_bytes(blob[offset:offset+2], 'little')
-    #offset += 2 + b6len
-    categoriesLenRelative = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    categoriesLastOffset = categoriesLenRelative + offset
-    catCountLen = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    catCount = int.from_bytes(blob[offset:offset+catCountLen], 'little')
-    offset += catCountLen
-    while offset < categoriesLastOffset:
-        entryLen = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        category = parse_memo_blob_category(blob[offset:offset+entryLen])
-        offset += entryLen
-        #if category['catType'] == "archive":
-        if category['useCategory']:
-            categories[category["id"]] = category
-        
-    return categories
+class CategorySnapshot:
+    """Immutable lookup tables for the archive categories. A new snapshot is built
+    on every reload and published as a whole, so readers never need a lock."""
+    __slots__ = ('ids', 'rows', 'categories', 'colors', 'labels', 'decorations', 'letters')
 
-def parse_memo_blob_category(blob):
-    offset = 0
-    name = None
-    keycode = None
-    red = None
-    blue = None
-    green = None
-    unknown2 = None
-    unknown3 = None
-    unknown4 = None
-    auftrag = None
-    unknown6 = None
-    key2 = None
-    useCategory = True
-    dayprotocol =  True
-    autosend = False
-    emergencysend = False
-    externalfile = False
-    catType = None
-    
-    b1len = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    b1 = blob[offset:offset+b1len]
-    offset += b1len
-    catidlen = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    catid = int.from_bytes(blob[offset:offset+catidlen], 'little')
-    offset += catidlen
-    kbtlen = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    kbt = blob[offset:offset+kbtlen-1].decode('cp1252')
-    offset += kbtlen
-    unklen5 = int.from_bytes(blob[offset:offset+2], 'little')
-    offset += 2
-    if unklen5 < 20:
-        if unklen5 > 0:
-            auftrag = blob[offset:offset+unklen5-1].decode('cp1252')
-            offset += unklen5
-        unklen3 = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        offset += unklen3
-        unklen4 = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        infobytes = blob[offset:offset+unklen4]
-        configbyte = 0b00000000
-        if len(infobytes) > 0:
-            configbyte = infobytes[0]
-        if configbyte & MOMask.NOTUSECATEGORY:
-            useCategory = False
-        if configbyte & MOMask.DAYPROTOCOL:
-            dayprotocol = False
-        if configbyte & MOMask.AUTOSEND:
-            autosend = True
-        if configbyte & MOMask.EMERGENCYSEND:
-            emergencysend = True
-        offset += unklen4
-        unklen6 = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        if unklen6 > 0:
-            unknown6 = int.from_bytes(blob[offset:offset+unklen6], 'little')
-            offset += unklen6
-        namelen = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        name = blob[offset:offset+namelen-1].decode('cp1252')
-        offset += namelen
-        key2len = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        if key2len > 0:
-            key2 = blob[offset:offset+key2len-1]
-            offset += key2len
-        else:
-            key2 = None
-        keycodelen = int.from_bytes(blob[offset:offset+2], 'little')
-        offset += 2
-        keycode = blob[offset:offset+keycodelen-1].decode('cp1252')
-        offset += keycodelen
-        if blob[offset:offset+2] == bytes.fromhex('0000'):
-            offset += 2
-            colorlen = int.from_bytes(blob[offset:offset+2], 'little')
-            offset += 2
-            if colorlen == 4:
-                red = blob[offset]
-                offset += 1
-                green = blob[offset]
-                offset += 1
-                blue = blob[offset]
-                offset += 2
+    def __init__(self, fullcategories = None, archivecategories = None, letters = ()):
+        if fullcategories is None:
+            fullcategories = {}
+        if archivecategories is None:
+            archivecategories = OrderedDict()
+        self.categories = archivecategories
+        self.letters = tuple(letters)
+        self.ids = tuple(archivecategories.keys())
+        self.rows = { id: row for (row, id) in enumerate(self.ids) }
+        self.colors = { id: { 'red': cat['red'], 'green': cat['green'], 'blue': cat['blue'] } for (id, cat) in fullcategories.items() }
+        self.labels = tuple('{name} ({krankenblatt})'.format(**cat) for cat in archivecategories.values())
+        decorations = []
+        for id in self.ids:
+            colors = self.colors.get(id)
+            if colors is not None and colors['red'] is not None:
+                decorations.append(QColor.fromRgb(colors['red'], colors['green'], colors['blue']))
             else:
-                offset += colorlen
-        else:
-            red = None
-            green = None
-            blue = None       
-    
-    return { 'id': catid, 'krankenblatt': kbt,  'auftrag': auftrag,  'name': name, 'keycode': keycode, 'key2': key2, 'red': red, 'green': green, 
-                'blue': blue, 'useCategory': useCategory, 'dayProtocol': dayprotocol, 'autosend': autosend, 'emergencysend': emergencysend}
+                decorations.append(QColor.fromRgb(255, 255, 255, 0))
+        self.decorations = tuple(decorations)
 
 class CategoryModel(QAbstractListModel):
-    def __init__(self, con):
+    def __init__(self, pool):
         super(CategoryModel, self).__init__()
-        self._con = con
+        self._pool = pool
         self._mutex = QMutex()
-        self._fullcategories = {}
-        self._archivecategories = {}
+        self._snapshot = CategorySnapshot()
         self.reloadCategories()
 
     @contextmanager
@@ -186,29 +89,82 @@ class CategoryModel(QAbstractListModel):
                 #print("Lock released: {}".format(msg))
                 pass
     
+    def snapshot(self):
+        return self._snapshot
+    
     def allCategories(self):
-        with self.lock('allCategories'):
-            return self._archivecategories
+        return self._snapshot.categories
+    
+    def letterCategories(self):
+        return self._snapshot.letters
+    
+    def _catalogFile(self):
+        defaultfile = os.sep.join([os.environ.get("LocalAppData", os.environ["AppData"]), "ArchivViewer", "categories.cache"])
+        return ConfigReader.get_instance().getValue('categoryCacheFile', defaultfile)
+    
+    def _readCachedCatalog(self, fingerprint):
+        try:
+            with open(self._catalogFile(), "rb") as f:
+                cached = pickle.load(f)
+            if cached['fingerprint'] == fingerprint:
+                return cached['catalog']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            LOGGER.debug("Category cache is not usable: {}".format(e))
+        
+        return None
+    
+    def _writeCachedCatalog(self, fingerprint, catalog):
+        catalogfile = self._catalogFile()
+        tmpfile = '{}.{}.part'.format(catalogfile, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(catalogfile), exist_ok = True)
+            with open(tmpfile, "wb") as f:
+                pickle.dump({ 'fingerprint': fingerprint, 'catalog': catalog }, f)
+            os.replace(tmpfile, catalogfile)
+        except OSError as e:
+            LOGGER.debug("Failed to write category cache '{}': {}".format(catalogfile, e))
+    
+    def _parseCatalog(self, blobs):
+        """Parses the category definitions of MOSYSTEM. Returns the memo categories and
+        the letter categories."""
+        try:
+            fullcategories = parse_memo_blob(blobs[0])
+        except:
+            dumpfile = os.sep.join([os.path.dirname(os.path.abspath(sys.argv[0])), "MO-Memo-Dump.hex"])
+            try:
+                with open(dumpfile, "wb") as f:
+                    f.write(blobs[0])
+            except:
+                pass
+            raise
+        
+        letters = []
+        if blobs[1] is not None:
+            try:
+                letters = parse_briefe_blob(blobs[1])
+            except Exception as e:
+                LOGGER.info("Failed to parse the letter categories: {}".format(e))
+        
+        return (fullcategories, letters)
     
     def reloadCategories(self):
-        cur = self._con.cursor()
-        cur.execute("SELECT s.FMEMO, s.FBRIEFKATEGORIELISTE, s.FABLAGELISTE, s.FKATEGORIELISTE FROM MOSYSTEM s")
-        for blobs in cur:
-            self.beginResetModel()
+        with self._pool.connection() as con:
+            cur = con.cursor()
+            cur.execute("SELECT s.FMEMO, s.FBRIEFKATEGORIELISTE, s.FABLAGELISTE, s.FKATEGORIELISTE FROM MOSYSTEM s")
+            rows = cur.fetchall()
+        for blobs in rows:
             with self.lock("reloadCategories"):
-                try:
-                    self._fullcategories = parse_memo_blob(blobs[0])
-                except:
-                    dumpfile = os.sep.join([os.path.dirname(os.path.abspath(sys.argv[0])), "MO-Memo-Dump.hex"])
-                    try:
-                        with open(dumpfile, "wb") as f:
-                            f.write(blobs[0])
-                    except:
-                        pass
-                    raise
+                fingerprint = catalogFingerprint(blobs)
+                catalog = self._readCachedCatalog(fingerprint)
+                if catalog is None:
+                    catalog = self._parseCatalog(blobs)
+                    self._writeCachedCatalog(fingerprint, catalog)
+                fullcategories, letters = catalog
                 archivecategories = {}
                 filterprefixes = [ 'Bildarchiv', 'Externe Datei', 'Brief' ]
-                for (catid, cat) in self._fullcategories.items():
+                for (catid, cat) in fullcategories.items():
                     LOGGER.debug("Splitting {}: {}".format(catid, cat["name"]))
                     try:
                         prefix, shortname = cat["name"].split(" - ", 1)
@@ -217,45 +173,48 @@ class CategoryModel(QAbstractListModel):
                     except ValueError:
                         pass
                     
-                self._archivecategories = OrderedDict(sorted(archivecategories.items(), key=lambda item: item[1]['name']))
+                snapshot = CategorySnapshot(fullcategories, OrderedDict(sorted(archivecategories.items(), key=lambda item: item[1]['name'])), letters)
                 
-            self.endResetModel()
+                self.beginResetModel()
+                self._snapshot = snapshot
+                self.endResetModel()
             break
         del cur
         
     def rowCount(self, _):
-        with self.lock("rowCount"):
-            return len(self._archivecategories)
+        return len(self._snapshot.ids)
     
     def categoryById(self, id):
-        with self.lock("nameById"):
-            return self._archivecategories[id]
+        return self._snapshot.categories[id]
     
     def idAtRow(self, row):
-        with self.lock("idAtRow"):
-            return list(self._archivecategories.keys())[row]
+        return self._snapshot.ids[row]
+    
+    def rowById(self, id):
+        return self._snapshot.rows[id]
     
     def colorById(self, id):
-        with self.lock("colorById"):
-            fullcat = self._fullcategories[id]
-            
-        return { 'red': fullcat['red'], 'green': fullcat['green'], 'blue': fullcat['blue'] }
+        return self._snapshot.colors[id]
+    
+    def selectionForIds(self, ids):
+        """Returns a QItemSelection of the rows of the given category ids, with
+        adjacent rows merged into one range."""
+        snapshot = self._snapshot
+        rows = sorted(snapshot.rows[id] for id in set(ids) if id in snapshot.rows)
+        selection = QItemSelection()
+        start = None
+        for (i, row) in enumerate(rows):
+            if start is None:
+                start = row
+            if i + 1 == len(rows) or rows[i + 1] != row + 1:
+                selection.append(QItemSelectionRange(self.index(start), self.index(row)))
+                start = None
+        
+        return selection
     
     def data(self, index, role):
+        snapshot = self._snapshot
         if role == Qt.DisplayRole:
-            with self.lock("data / DisplayRole"):
-                return '{name} ({krankenblatt})'.format(**list(self._archivecategories.values())[index.row()])
+            return snapshot.labels[index.row()]
         elif role == Qt.DecorationRole:
-            with self.lock("data / BackgroundRole"):
-                try:
-                    id = list(self._archivecategories.keys())[index.row()]
-                    fullcat = self._fullcategories[id]
-                    red = fullcat['red']
-                    if red is not None:
-                        green = fullcat['green']
-                        blue = fullcat['blue']
-                        return QColor.fromRgb(red, green, blue)
-                    else:
-                        return QColor.fromRgb(255, 255, 255, 0)
-                except KeyError:
-                    return QColor.fromRgb(255, 255, 255, 0)
+            return snapshot.decorations[index.row()]
@@ -0,0 +1,127 @@
+# ConnectionPool.py
+
+import time, logging, threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+class ConnectionPoolError(Exception):
+    pass
+
+class ConnectionPool:
+    """Thread-safe pool of connections to one Firebird database.
+
+    fdb connections must not be used by several threads at once, so every thread
+    checks out a connection of its own for the duration of a job and returns it
+    afterwards. A connection which has been idle for a while is checked with a
+    trivial query before it is handed out again; broken connections are closed and
+    replaced by new ones. At most maxSize connections are open at the same time,
+    further checkouts wait until one is returned."""
+
+    HEALTH_CHECK = "SELECT 1 FROM RDB$DATABASE"
+
+    def __init__(self, name, connect, connections = None, maxSize = 6, checkAfter = 30, timeout = 60):
+        self.name = name
+        self._connect = connect
+        self._maxSize = max(1, maxSize)
+        self._checkAfter = checkAfter
+        self._timeout = timeout
+        self._available = threading.Condition()
+        # idle connections with the time they were returned, most recent last
+        self._idle = [ (con, time.monotonic()) for con in (connections or []) ]
+        self._size = len(self._idle)
+        self._closed = False
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection. It is closed instead of being returned to the pool
+        if the block raises a database error."""
+        con = self.acquire()
+        broken = False
+        try:
+            yield con
+        except Exception as e:
+            broken = self.isDatabaseError(e)
+            raise
+        finally:
+            self.release(con, broken)
+
+    @staticmethod
+    def isDatabaseError(e):
+        # avoids importing fdb here, its exceptions derive from fdb.Error
+        return any(cls.__module__.startswith('fdb') for cls in type(e).__mro__)
+
+    def acquire(self):
+        deadline = time.monotonic() + self._timeout
+        with self._available:
+            while len(self._idle) == 0 and self._size >= self._maxSize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionPoolError("Keine freie Verbindung zur Datenbank {} verfügbar".format(self.name))
+                self._available.wait(remaining)
+            if len(self._idle) > 0:
+                con, since = self._idle.pop()
+            else:
+                con, since = None, None
+                self._size += 1
+
+        try:
+            if con is not None and time.monotonic() - since > self._checkAfter and not self._isHealthy(con):
+                LOGGER.info("Connection to {} is broken, reconnecting".format(self.name))
+                self._close(con)
+                con = None
+            if con is None:
+                con = self._connect()
+        except:
+            with self._available:
+                self._size -= 1
+                self._available.notify()
+            raise
+
+        return con
+
+    def release(self, con, broken = False):
+        if not broken:
+            try:
+                # ends the read transaction, the next user sees current data
+                con.commit()
+            except Exception as e:
+                LOGGER.debug("Connection to {} failed on release: {}".format(self.name, e))
+                broken = True
+        with self._available:
+            broken = broken or self._closed
+        if broken:
+            self._close(con)
+        with self._available:
+            if broken:
+                self._size -= 1
+            else:
+                self._idle.append((con, time.monotonic()))
+            self._available.notify()
+
+    def _isHealthy(self, con):
+        try:
+            cur = con.cursor()
+            cur.execute(self.HEALTH_CHECK)
+            cur.fetchall()
+            cur.close()
+            return True
+        except Exception as e:
+            LOGGER.debug("Health check of {} failed: {}".format(self.name, e))
+            return False
+
+    def _close(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Closes the idle connections, connections still checked out are closed on release."""
+        with self._available:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+        for (con, _) in idle:
+            self._close(con)
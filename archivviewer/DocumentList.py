@@ -0,0 +1,89 @@
+# DocumentList.py
+
+from array import array
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+START_DATE = datetime(1890, 1, 1)
+
+@lru_cache(maxsize = None)
+def dateLabel(date):
+    return (START_DATE + timedelta(days = date)).strftime('%d.%m.%Y')
+
+@lru_cache(maxsize = None)
+def timeLabel(time):
+    return '{:02d}:{:02d}'.format(time // 3600, time % 3600 // 60)
+
+class DocumentList:
+    """Column-wise storage for the documents of a patient.
+
+    Every column is a flat array and dates are kept as the raw FDATUM/FZEIT
+    integers of the ARCHIV table, so a row costs a few bytes per column instead
+    of a dict with a datetime. Rows are addressed by their position, filtered
+    views are arrays of row numbers.
+
+    The formatted date and time of each row are computed once on append. They
+    are shared between all rows of the same day or minute. The lower case
+    search keys are only built once the list is filtered by text, see
+    searchKeys()."""
+    __slots__ = ('ids', 'dates', 'times', 'categories', 'archived', 'descriptions', '_searchkeys', 'datelabels', 'timelabels')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.dates = array('l')
+        self.times = array('l')
+        self.categories = array('l')
+        self.archived = array('b')
+        self.descriptions = []
+        self._searchkeys = None
+        self.datelabels = []
+        self.timelabels = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, id, description, category, time, date, archived = False):
+        self.ids.append(id)
+        self.dates.append(date)
+        self.times.append(time)
+        self.categories.append(category)
+        self.archived.append(1 if archived else 0)
+        self.descriptions.append(description)
+        if self._searchkeys is not None:
+            self._searchkeys.append(description.lower())
+        self.datelabels.append(dateLabel(date))
+        self.timelabels.append(timeLabel(time))
+
+    def extend(self, other):
+        self.ids.extend(other.ids)
+        self.dates.extend(other.dates)
+        self.times.extend(other.times)
+        self.categories.extend(other.categories)
+        self.archived.extend(other.archived)
+        self.descriptions.extend(other.descriptions)
+        if self._searchkeys is not None:
+            self._searchkeys.extend(other.searchKeys())
+        self.datelabels.extend(other.datelabels)
+        self.timelabels.extend(other.timelabels)
+
+    def searchKeys(self):
+        """Returns the lower case descriptions, built on first use."""
+        if self._searchkeys is None:
+            self._searchkeys = [ description.lower() for description in self.descriptions ]
+        return self._searchkeys
+
+    def datetime(self, row):
+        return START_DATE + timedelta(days = self.dates[row], seconds = self.times[row])
+
+    def document(self, row):
+        """Returns the document at row in the dict form the workers expect."""
+        file = {
+            'id': self.ids[row],
+            'datum': self.datetime(row),
+            'beschreibung': self.descriptions[row],
+            'category': self.categories[row]
+        }
+        if self.archived[row]:
+            file['medoffarc'] = True
+
+        return file
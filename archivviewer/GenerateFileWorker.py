@@ -1,78 +1,130 @@
 # GenerateFileWorker.py
 
-import io, logging, email, subprocess, os, tempfile, shutil, sys
-from contextlib import contextmanager
+import io, logging, subprocess, os, sys, shutil, tempfile, time, queue, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from PyQt5.QtCore import QObject, pyqtSignal
-from lhafile import LhaFile
-import img2pdf
-import libjpeg
-from PIL import Image, ImageFile
-import PIL
 from PyPDF2 import PdfFileMerger
 from subprocess import PIPE
 from .configreader import ConfigReader
+from .PdfCache import PdfCache
+from .ArchiveConverter import ArchiveConverter, convertBlobFile, initConversionProcess
+from .PartStore import PartStore, optionsFingerprint
+from .ConnectionPool import ConnectionPool
+from .BlobPrefetcher import BlobPrefetcher, streamBlob
 
 LOGGER = logging.getLogger(__name__)
 
-@contextmanager
-def tempdir(prefix='tmp'):
-    """A context manager for creating and then deleting a temporary directory."""
-    tmpdir = tempfile.mkdtemp(prefix=prefix)
-    try:
-        yield tmpdir
-    finally:
-        shutil.rmtree(tmpdir)
-
 class ExportCancelledError(Exception):
     pass
 
+# the part store is pruned once per export, jobs for single documents prune it
+# at most every PRUNE_INTERVAL seconds as scanning the directory is not free
+PRUNE_INTERVAL = 10*60
+_lastPrune = None
+
 class GenerateFileWorker(QObject):
     initGenerate = pyqtSignal(int, bool)
     initExport = pyqtSignal(int)
     progress = pyqtSignal(bool)
+    progressValue = pyqtSignal(bool, int)
     progressExport = pyqtSignal()
     completed = pyqtSignal(str, dict, list, bool)
-    exportCompleted = pyqtSignal(str, int, int, list, bool)
+    exportCompleted = pyqtSignal(str, int, int, list, bool, dict)
     exportCancelled = pyqtSignal()
     fileProgressStatus = pyqtSignal(str)
     exportProgressStatus = pyqtSignal(str)
     kill = pyqtSignal()
         
-    def __init__(self, tmpdir, files, con, arccon, librepath, gimppath, gspath, exportDestination = None, parent = None):
+    def __init__(self, tmpdir, files, pool, arcpool, librepath, gimppath, gspath, exportDestination = None, office = None, parent = None):
         super(GenerateFileWorker, self).__init__(parent)
         self._tmpdir = tmpdir
         self._files = files
         self._gimppath = gimppath
         self._librepath = librepath
-        self._con = con
-        self._arccon = arccon
+        self._pools = { 'MEDOFF': pool, 'MEDOFFARC': arcpool }
+        # connections checked out for this job, returned by _releaseConnections
+        self._connections = {}
         self._destination = exportDestination
         self._cancelled = False
-        self._config = ConfigReader.get_instance()
+        # settings changed while the job runs do not apply to it
+        self._config = ConfigReader.get_instance().snapshot()
         self._gspath = gspath
+        self._cache = PdfCache.get_instance()
+        self._workers = self._config.getValue('exportWorkers', 1)
+        if self._workers <= 0:
+            self._workers = os.cpu_count() or 1
+        options = { 'useGimpForTiff': self._config.getValue('useGimpForTiff', False), 'useImg2pdf': self._config.getValue('useImg2pdf', False),
+            'fitToA4': self._config.getValue('fitToA4', False), 'gimpForAllTiffs': self._config.getValue('gimpForAllTiffs', False) }
+        self._partStoreMaxBytes = self._config.getValue('partStoreMaxBytes', 512*1024*1024)
+        partStore = None
+        if self._partStoreMaxBytes > 0:
+            defaultdir = os.sep.join([os.environ.get("LocalAppData", os.environ["AppData"]), "ArchivViewer", "parts"])
+            partStore = PartStore(self._config.getValue('partStoreDir', defaultdir))
+        # dedupeHits and dedupeBytes: parts taken from the part store instead of being converted
+        self._stats = {}
+        # documents which could not be fetched, by index, with the error message
+        self._failed = {}
+        self._options = options
+        self._converter = ArchiveConverter(tmpdir, librepath, gimppath, options, isolatedProfile = self._workers > 1, partStore = partStore)
+        self._converter.office = office
+        self._converter.setCallbacks(status = self.fileProgressStatus.emit, initGenerate = lambda count: self.initGenerate.emit(count, self._destination is not None),
+            progress = lambda: self.progress.emit(self._destination is not None), checkCancelled = self._raiseIfCancelled)
         
+    def _addStats(self, stats):
+        for (name, value) in stats.items():
+            self._stats[name] = self._stats.get(name, 0) + value
+    
+    def _connection(self, database):
+        if database not in self._connections:
+            self._connections[database] = self._pools[database].acquire()
+        return self._connections[database]
+    
+    def _releaseConnections(self, broken = ()):
+        for (database, con) in self._connections.items():
+            self._pools[database].release(con, database in broken)
+        self._connections = {}
+    
+    def _prunePartStore(self):
+        global _lastPrune
+        if self._converter.parts is None:
+            return
+        now = time.monotonic()
+        if self._destination is not None or _lastPrune is None or now - _lastPrune >= PRUNE_INTERVAL:
+            _lastPrune = now
+            self._converter.parts.prune(self._partStoreMaxBytes)
+    
     def work(self):
         try:
+            self._prunePartStore()
             if self._destination is None:
                 filename, errors = self.generateFile(self._files[0])
-                self.exportCompleted.emit(filename, 1, 1 if filename is None else 0, errors, False)
+                self.exportCompleted.emit(filename, 1, 1 if filename is None else 0, errors, False, self._stats)
             else:
+                ready = self._prepareExport()
+                try:
+                    if self._workers > 1 and len(self._files) > 1:
+                        results = self._generateParallel(ready)
+                    else:
+                        results = self._generateSequential(ready)
+                finally:
+                    # stops the prefetcher if the export has been aborted
+                    ready.close()
+                    for file in self._files:
+                        self._removeBlob(self._blobFile(file))
+                    shutil.rmtree(os.sep.join([self._tmpdir, 'parts']), ignore_errors = True)
+                
                 failed = 0
                 counter = 0
                 errorMessages = []
                 merger = PdfFileMerger()
-                for f in self._files:
-                    self._raiseIfCancelled()
+                for (f, (filename, errors)) in zip(self._files, results):
                     counter += 1
-                    filename, errors = self.generateFile(f)
                     errorMessages.extend(errors)
-                    self._raiseIfCancelled()
                     if filename is None:
                         failed += 1
                     else:
                         bmtext = " ".join([f["beschreibung"], f["datum"].strftime('%d.%m.%Y %H:%M')])
                         merger.append(filename, bookmark=bmtext)
-                    self.progressExport.emit()
                 
                 tmpdest = self._destination
                 if self._gspath is not None and self._config.getValue("shrinkPDF", True):
@@ -93,10 +145,302 @@ class GenerateFileWorker(QObject):
                     result = subprocess.run([self._gspath, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4', '-dPDFSETTINGS=/printer',
                         '-dNOPAUSE', '-dQUIET', '-dBATCH', '-sOutputFile={}'.format(self._destination), tmpdest], check=True, stdout=PIPE, stderr=PIPE)
                 
-                self.exportCompleted.emit(self._destination, counter, failed, errorMessages, True)
+                if self._stats.get('dedupeHits', 0) > 0:
+                    LOGGER.info("Export: {} parts reused from the part store, {} bytes".format(self._stats['dedupeHits'], self._stats['dedupeBytes']))
+                self.exportCompleted.emit(self._destination, counter, failed, errorMessages, True, self._stats)
         except ExportCancelledError:
             self.exportCancelled.emit()
+        except Exception as e:
+            # e.g. the database is unreachable, the progress display must not get stuck
+            LOGGER.debug("Export failed: {}".format(e))
+            count = len(self._files)
+            self.exportCompleted.emit(self._destination or '', count, count, [ "Fehler beim Export: {}".format(e) ], self._destination is not None, self._stats)
+        finally:
+            self._releaseConnections()
+        
+    def _pdfFile(self, file):
+        # PDFs rendered with other settings earlier in the session are not reused
+        return os.sep.join([self._tmpdir, '{}-{}.pdf'.format(file["id"], optionsFingerprint(self._options))])
+    
+    def _blobFile(self, file):
+        return os.sep.join([self._tmpdir, '{}.lzh'.format(file["id"])])
+    
+    def _prepareExport(self):
+        """Fetches the blobs of all documents which are not rendered yet and stores the
+        ones not found in the PDF cache in the temp dir, see BlobPrefetcher. Yields
+        (index, prepared) for every document as soon as it can be converted; prepared
+        is a (cachekey, blobfile, convertedParts) tuple or None if the document is
+        already available as PDF or missing from the database, see self._failed.
+        
+        Documents are handed on while the rest is still being fetched, so the
+        prefetcher's byte limit bounds the blobs waiting in the temp dir. Documents
+        with office parts, or TIFFs if these are to be rendered by GIMP, are the
+        exception: the parts are converted in one batch each once everything is
+        fetched, and the documents containing them wait until then."""
+        officeFiles = []
+        tiffFiles = []
+        partsdir = os.sep.join([self._tmpdir, 'parts'])
+        batchOffice = self._librepath is not None and self._config.getValue('batchOfficeConversion', True)
+        batchGimp = self._converter.useGimpForAllTiffs()
+        if batchOffice or batchGimp:
+            os.makedirs(partsdir, exist_ok = True)
+
+        fetch = []
+        for (idx, file) in enumerate(self._files):
+            if os.path.isfile(self._pdfFile(file)):
+                yield (idx, None)
+            else:
+                fetch.append(idx)
+        
+        waiting = []
+        prefetcher = BlobPrefetcher(self._pools, [ self._files[idx] for idx in fetch ], self._blobFile,
+            chunkSize = self._config.getValue('blobFetchChunkSize', 50), maxBytes = self._config.getValue('exportPrefetchBytes', 64*1024*1024))
+        prefetcher.start()
+        try:
+            for (counter, (fetchIdx, database, fingerprint)) in enumerate(prefetcher, 1):
+                self._raiseIfCancelled()
+                self.exportProgressStatus.emit('Lade Dokument {} von {}...'.format(counter, len(fetch)))
+                idx = fetch[fetchIdx]
+                file = self._files[idx]
+                if fingerprint is None:
+                    self._failed[idx] = "{}: Dokument nicht in der Datenbank gefunden".format(file["beschreibung"])
+                    yield (idx, None)
+                    continue
+                filename = self._pdfFile(file)
+                blobfile = self._blobFile(file)
+                cachekey = PdfCache.key(database, file["id"], fingerprint, self._options)
+                if self._cache.get(cachekey, filename):
+                    os.unlink(blobfile)
+                    yield (idx, None)
+                    continue
+                
+                parts = {}
+                if batchOffice or batchGimp:
+                    try:
+                        with open(blobfile, 'rb') as ios:
+                            officeParts, tiffParts = self._converter.extractParts(file, ios, partsdir, office = batchOffice, tiff = batchGimp)
+                        officeFiles.extend(officeParts.values())
+                        tiffFiles.extend(tiffParts.values())
+                        parts = { **officeParts, **tiffParts }
+                    except Exception as e:
+                        LOGGER.debug("{}: Failed to extract parts for batch conversion: {}".format(file["beschreibung"], e))
+                if len(parts) > 0:
+                    waiting.append((idx, (cachekey, blobfile, parts)))
+                else:
+                    yield (idx, (cachekey, blobfile, parts))
+        finally:
+            prefetcher.stop()
+
+        if len(waiting) == 0:
+            return
+        manifest = self._batchConvert(officeFiles, tiffFiles, partsdir)
+        
+        # documents pick up their converted parts from the manifest, parts which
+        # failed are converted individually later on, ones which timed out are
+        # reported as errors
+        for (idx, prepared) in waiting:
+            parts = prepared[2]
+            for (index, infile) in list(parts.items()):
+                if infile in manifest:
+                    parts[index] = manifest[infile]
+                else:
+                    del parts[index]
+            yield (idx, prepared)
+
+    def _batchConvert(self, officeFiles, tiffFiles, partsdir):
+        """Converts the extracted parts in batches and returns the manifest mapping
+        each part to its PDF. Parts available in the part store and repeated parts
+        within the export are not converted again."""
+        manifest = {}
+        keys = {}
+        originals = {}
+        batches = ([], [])
+        for (batch, infiles) in zip(batches, (officeFiles, tiffFiles)):
+            for infile in infiles:
+                with open(infile, 'rb') as f:
+                    key = self._converter.partKey(f.read())
+                if key is None:
+                    batch.append(infile)
+                    continue
+                keys[infile] = key
+                if key in originals:
+                    continue
+                originals[key] = infile
+                data = self._converter.parts.get(key)
+                if data is None:
+                    batch.append(infile)
+                    continue
+                pdffile = os.path.splitext(infile)[0] + '.pdf'
+                with open(pdffile, 'wb') as f:
+                    f.write(data)
+                manifest[infile] = pdffile
+                self._addStats({ 'dedupeHits': 1, 'dedupeBytes': len(data) })
+        
+        (officeBatch, tiffBatch) = batches
+        converted = {}
+        if len(officeBatch) > 0:
+            self.exportProgressStatus.emit('Konvertiere {} Briefe...'.format(len(officeBatch)))
+            converted.update(self._converter.convertOfficeBatch(officeBatch, partsdir))
+        if len(tiffBatch) > 0:
+            self.exportProgressStatus.emit('Konvertiere {} TIFF-Dateien mit GIMP...'.format(len(tiffBatch)))
+            converted.update(self._converter.convertGimpBatch(tiffBatch, partsdir))
+        manifest.update(converted)
+        
+        for (infile, key) in keys.items():
+            original = originals[key]
+            if infile == original:
+                if converted.get(infile) is not None:
+                    with open(converted[infile], 'rb') as f:
+                        self._converter.parts.put(key, f.read())
+            elif original in manifest:
+                # a part which timed out is reported for every document containing it
+                manifest[infile] = manifest[original]
+                if manifest[original] is not None:
+                    self._addStats({ 'dedupeHits': 1, 'dedupeBytes': os.path.getsize(manifest[original]) })
+        
+        return manifest
+    
+    def _generateSequential(self, ready):
+        """Converts the documents yielded by ready, see _prepareExport, one after the
+        other. Results are returned in the order of self._files."""
+        results = [ None ] * len(self._files)
+        for (idx, p) in ready:
+            f = self._files[idx]
+            self._raiseIfCancelled()
+            if idx in self._failed:
+                results[idx] = (None, [ self._failed[idx] ])
+                self.completed.emit(None, f, [ self._failed[idx] ], True)
+            else:
+                results[idx] = self.generateFile(f, p)
+                if p is not None:
+                    self._removeBlob(p[1])
+            self._raiseIfCancelled()
+            self.progressExport.emit()
         
+        return results
+    
+    def _generateParallel(self, ready):
+        """Converts the documents yielded by ready, see _prepareExport, in a process
+        pool. At most two documents per process are queued, so that fetching does
+        not run further ahead than the prefetcher allows. Results are returned in
+        the order of self._files regardless of completion order.
+        
+        The processes report the parts they convert through a queue; the file
+        progress shows the parts of all documents handed to the pool so far. On
+        cancellation the running conversions stop at their next part."""
+        results = [ None ] * len(self._files)
+        pending = {}
+        progressQueue = multiprocessing.Queue()
+        cancelEvent = multiprocessing.Event()
+        parts = [ 0, 0 ]
+        
+        def updateProgress():
+            changed = False
+            while True:
+                try:
+                    (count, done) = progressQueue.get_nowait()
+                except queue.Empty:
+                    break
+                parts[0] += count
+                parts[1] += done
+                changed = True
+            if changed:
+                self.initGenerate.emit(parts[0], True)
+                self.progressValue.emit(True, parts[1])
+        
+        def collect(futures):
+            for future in futures:
+                (idx, cachekey, blobfile) = pending.pop(future)
+                file = self._files[idx]
+                try:
+                    filename, errors, stats = future.result()
+                    self._addStats(stats)
+                except Exception as e:
+                    LOGGER.debug("Exception on generating file: {}".format(e))
+                    filename = None
+                    errors = [ "{}: Fehler bei der Konvertierung: {}".format(file["beschreibung"], e) ]
+                if filename is not None and len(errors) == 0:
+                    self._cache.put(cachekey, filename)
+                self._removeBlob(blobfile)
+                results[idx] = (filename, errors)
+                self.completed.emit(filename, file, errors, True)
+                self.progressExport.emit()
+        
+        def waitForSome(timeout):
+            done, _ = wait(pending.keys(), timeout = timeout, return_when = FIRST_COMPLETED)
+            updateProgress()
+            collect(done)
+            self._raiseIfCancelled()
+        
+        executor = ProcessPoolExecutor(max_workers = self._workers, initializer = initConversionProcess, initargs = (progressQueue, cancelEvent))
+        try:
+            for (idx, p) in ready:
+                file = self._files[idx]
+                if idx in self._failed:
+                    results[idx] = (None, [ self._failed[idx] ])
+                    self.completed.emit(None, file, [ self._failed[idx] ], True)
+                    self.progressExport.emit()
+                elif p is None:
+                    results[idx] = (self._pdfFile(file), [])
+                    self.progressExport.emit()
+                else:
+                    while len(pending) >= 2 * self._workers:
+                        waitForSome(0.2)
+                    (cachekey, blobfile, convertedParts) = p
+                    pending[executor.submit(convertBlobFile, self._converter, file, blobfile, self._pdfFile(file), convertedParts)] = (idx, cachekey, blobfile)
+                collect([ future for future in pending if future.done() ])
+            
+            self.fileProgressStatus.emit("Warte auf Konvertierung...")
+            while len(pending) > 0:
+                waitForSome(0.2)
+        finally:
+            cancelEvent.set()
+            if sys.version_info >= (3, 9):
+                executor.shutdown(wait = True, cancel_futures = True)
+            else:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown(wait = True)
+            progressQueue.close()
+        
+        return results
+    
+    def _removeBlob(self, blobfile):
+        try:
+            os.unlink(blobfile)
+        except OSError:
+            pass
+    
+    def _fetchBlob(self, file, out, chunksize = 256*1024):
+        """Streams the FDATEI blob of file into the file object out in chunks, so that
+        the blob never has to be held in memory as a whole. Returns the database the
+        document was read from and the fingerprint of the blob. A broken connection
+        is replaced and the blob is read once more."""
+        database = 'MEDOFFARC' if 'medoffarc' in file else 'MEDOFF'
+        try:
+            return (database, self._readBlob(self._connection(database), file, out, chunksize))
+        except Exception as e:
+            if not ConnectionPool.isDatabaseError(e):
+                raise
+            LOGGER.info("{}: Reading the blob failed ({}), reconnecting to {}".format(file["beschreibung"], e, database))
+            con = self._connections.pop(database, None)
+            if con is not None:
+                self._pools[database].release(con, True)
+            out.seek(0)
+            out.truncate()
+            return (database, self._readBlob(self._connection(database), file, out, chunksize))
+    
+    def _readBlob(self, con, file, out, chunksize):
+        selectStm = "SELECT a.FDATEI FROM ARCHIV a WHERE a.FSUROGAT = ?"
+        cur = con.cursor()
+        cur.set_stream_blob('FDATEI')
+        cur.execute(selectStm, (file["id"],))
+        (datei,) = cur.fetchone()
+        fingerprint = streamBlob(datei, out, chunksize, self._raiseIfCancelled)
+        cur.close()
+        
+        return fingerprint
+    
     def cancel(self):
         self._cancelled = True
     
@@ -104,170 +448,37 @@ class GenerateFileWorker(QObject):
         if self._cancelled:
             raise ExportCancelledError('Export cancelled by user')
     
-    def generateFile(self, file):
-        filename = os.sep.join([self._tmpdir, '{}.pdf'.format(file["id"])])
+    def generateFile(self, file, prepared = None):
+        filename = self._pdfFile(file)
         collectedErrors = []
         cleanupfiles = []
         isExport = self._destination is not None
         
         try:
-            if not os.path.isfile(filename):
+            if prepared is not None:
+                (cachekey, blobfile, convertedParts) = prepared
+                with open(blobfile, 'rb') as ios:
+                    filename = self._converter.convert(file, ios, filename, collectedErrors, cleanupfiles, convertedParts, self._stats)
+                if filename is not None and len(collectedErrors) == 0:
+                    self._cache.put(cachekey, filename)
+
+                self.completed.emit(filename, file, collectedErrors, isExport)
+            elif not os.path.isfile(filename):
                 self.fileProgressStatus.emit("Hole Blob aus Datenbank...")
                 self._raiseIfCancelled()
-                selectStm = "SELECT a.FDATEI FROM ARCHIV a WHERE a.FSUROGAT = ?"
-                if 'medoffarc' in file:
-                    cur = self._arccon.cursor()
-                else:
-                    cur = self._con.cursor()
-                cur.execute(selectStm, (file["id"],))
-                (datei,) = cur.fetchone()
-                
-                merger = PdfFileMerger()
-                ios = None
-                try:
-                    contents = datei.read()
-                    ios = io.BytesIO(contents)
-                except:
-                    ios = io.BytesIO(datei)
-                
-                self._raiseIfCancelled()
-                self.fileProgressStatus.emit("Öffne Archivdatei...")
-                lf = LhaFile(ios)
-                
-                appended = False
-                loextensions = ('.odt', '.ods')
-                
-                attcounter = 0
+                # small blobs stay in memory, large ones are spooled to disk
+                ios = tempfile.SpooledTemporaryFile(max_size = self._config.getValue('blobSpoolThreshold', 16*1024*1024), dir = self._tmpdir)
+                database, fingerprint = self._fetchBlob(file, ios)
                 
-                self.initGenerate.emit(len(lf.namelist()), isExport)
-                
-                for name in lf.namelist():
-                    self._raiseIfCancelled()
-                    self.progress.emit(isExport)
-                    content = lf.read(name)
-                    _, extension = os.path.splitext(name)
-                    if content[0:5] == b'%PDF-':                  
-                        merger.append(io.BytesIO(content))
-                        appended = True
-                    elif content[0:5] == b'{\\rtf' or (content[0:4] == bytes.fromhex('504B0304') and extension in loextensions):
-                        if self._librepath is not None:
-                            with tempdir() as tmpdir:
-                                tmpfile = os.sep.join([tmpdir, "temp" + extension])
-                                pdffile = os.sep.join([tmpdir, "temp.pdf"])
-                                with open(tmpfile, "wb") as f:
-                                    f.write(content)
-                                command = '"'+" ".join(['"'+self._librepath+'"', "--convert-to pdf", "--outdir", '"'+tmpdir+'"', '"'+tmpfile+'"'])+'"'
-                                if os.system(command) == 0:
-                                    try:
-                                        with open(pdffile, "rb") as f:
-                                            merger.append(io.BytesIO(f.read()))
-                                            
-                                        appended = True
-                                    except:
-                                        err = "%s: Fehler beim Öffnen der konvertierten PDF-Datei '%s' (konvertiert aus '%s')" % (file['beschreibung'], pdffile, tmpfile)
-                                        collectedErrors.append(err)
-                                else:
-                                    err = "%s: Fehler beim Ausführen des Kommandos: '%s'" % (file['beschreibung'], command)
-                                    collectedErrors.append(err)
-                        else:
-                            err = "%s: Die Konvertierung nach PDF ist nicht möglich, da keine LibreOffice-Installation gefunden wurde"
-                            collectedErrors.append(err)
-                    elif name == "message.eml":
-                        # eArztbrief
-                        eml = email.message_from_bytes(content)
-                        errors = []                    
-                        for part in eml.get_payload():
-                            self._raiseIfCancelled()
-                            fnam = part.get_filename()
-                            partcont = part.get_payload(decode=True)
-                            if partcont[0:5] == b'%PDF-':
-                                merger.append(io.BytesIO(partcont))
-                                appended = True
-                            else:
-                                errors.append("%s: eArztbrief: nicht unterstütztes Anhangsformat in Anhang '%s'" % (file["beschreibung"], fnam))
-                        
-                        if not appended and len(errors) > 0:
-                            err = '\n'.join(errors)
-                            collectedErrors.append(err)
-                    else:
-                        try:
-                            if self._gimppath is not None and content[0:3] == b'II*' and self._config.getValue('useGimpForTiff', False):                                
-                                LOGGER.debug("{}: {}: Export via GIMP unter '{}'".format(file["beschreibung"], name, self._gimppath))
-                                tiffile = os.sep.join([self._tmpdir, '{}.{}.tif'.format(file["id"], attcounter)])
-                                outfile = os.sep.join([self._tmpdir, '{}.{}.pdf'.format(file["id"], attcounter)])
-                                cleanupfiles.append(tiffile)
-                                cleanupfiles.append(outfile)
-                                with open(tiffile, 'wb') as f:
-                                    f.write(content)
-                                batchscript = '(let* ((image (car (gimp-file-load RUN-NONINTERACTIVE "{infile}" "{infile}")))(drawable (car (gimp-image-get-active-layer image))))\
-                                    (file-pdf-save2 RUN-NONINTERACTIVE image drawable "{outfile}" "{outfile}" FALSE TRUE TRUE TRUE FALSE)(gimp-image-delete image) (gimp-quit 0))'.format(infile=tiffile.replace('\\', '\\\\'), outfile=outfile.replace('\\', '\\\\'))
-                                gimp_path = self._gimppath
-                                result = subprocess.run([gimp_path, '-i', '-b', batchscript], check=True, stdout=PIPE, stderr=PIPE)
-                                if result.stdout is not None or result.stderr is not None:
-                                    LOGGER.debug("GIMP output: {} {}".format(result.stdout, result.stderr))
-                                merger.append(outfile)
-                                appended = True
-                                attcounter += 1
-                            elif self._config.getValue('useImg2pdf', False) or content[0:4] == bytes.fromhex('FFD8FFE0'):
-                                LOGGER.debug("Using PIL for file conversion")
-                                inbuffer = io.BytesIO(content)
-                                try:
-                                    img = Image.open(inbuffer)
-                                    img.load()
-                                except OSError as e:
-                                    LOGGER.debug("Failed: {}. Trying libjpeg now for lossless compressed JPEG file.".format(e))
-                                    img = Image.fromarray(libjpeg.decode(content))
-                                if self._config.getValue('fitToA4', False):
-                                    twidth = 2480
-                                    theight = 3508
-                                    cwidth, cheight = img.size
-                                    if cwidth > twidth or cheight > theight:
-                                        img.resize((twidth, theight), resample = PIL.Image.LANCZOS)
-                                    elif cwidth < twidth and cheight < theight:
-                                        nimg = Image.new('RGB', (twidth, theight), color = 'white')
-                                        nimg.paste(img, (round((twidth-cwidth)/2), round((theight-cheight)/2)))
-                                        img = nimg
-                                outbuffer = io.BytesIO()
-                                img.save(outbuffer, 'PDF', resolution=300)
-                                merger.append(outbuffer)
-                                appended = True
-                                del inbuffer
-                            else:
-                                LOGGER.debug("Using img2pdf for file conversion")
-                                if self._config.getValue('fitToA4', False):
-                                    a4inpt = (img2pdf.mm_to_pt(210),img2pdf.mm_to_pt(297))
-                                    layout_fun = img2pdf.get_layout_fun(a4inpt)
-                                else:
-                                    layout_fun = None
-                                merger.append(io.BytesIO(img2pdf.convert(content), layout_fun=layout_fun))
-                                appended = True
-                        except Exception as e:
-                            err = "%s: Dateiinhalt '%s' ist kein unterstützter Dateityp -> wird nicht an PDF angehängt (%s)" % (file["beschreibung"], name, e)
-                            LOGGER.debug(err)
-                            collectedErrors.append(err)
-                
-                self._raiseIfCancelled()
-                if appended:
-                    try:
-                        merger.write(filename)
-                    except Exception as e:
-                        err = "{}: Fehler beim Schreiben der Ausgabedatei '{}': {}".format(file["beschreibung"], filename, e)
-                        self._av.displayErrorMessage(err)
+                cachekey = PdfCache.key(database, file["id"], fingerprint, self._options)
+                if self._cache.get(cachekey, filename):
+                    LOGGER.debug("{}: PDF aus Zwischenspeicher übernommen".format(file["beschreibung"]))
                 else:
-                    filename = None
-                    blobfilename = os.sep.join([self._tmpdir, '{}.blb'.format(file["id"])])
-                    ios.seek(0)
-                    with open(blobfilename, 'wb') as f:
-                        f.write(ios.read())
-                    err = "Ein Abzug des Blobinhalts wurde nach '{}' geschrieben. Er ist dort bis zum Programmende verfügbar.".format(blobfilename)
-                    collectedErrors.append(err)
-                    
-                merger.close()
+                    filename = self._converter.convert(file, ios, filename, collectedErrors, cleanupfiles, stats = self._stats)
+                    # incomplete PDFs are converted again next time
+                    if filename is not None and len(collectedErrors) == 0:
+                        self._cache.put(cachekey, filename)
                 
-                try:
-                    datei.close()
-                except:
-                    pass
                 ios.close()
                 
                 self.completed.emit(filename, file, collectedErrors, isExport)
@@ -284,4 +495,38 @@ class GenerateFileWorker(QObject):
             LOGGER.debug("File generation completed")
             
         
-        return (filename, collectedErrors)
\ No newline at end of file
+        return (filename, collectedErrors)
+
+
+class PrerenderWorker(GenerateFileWorker):
+    """Renders documents into the temp dir and the PDF cache ahead of time, so that
+    opening them later is instant. It is cancelled as soon as the user requests a
+    document or an export; cancellation is checked between the parts of a document.
+    Documents rendered before are left out, and the pooled connections are
+    returned after every document, so a cancelled job does not hold on to them.
+    It should be given an office converter of its own, a foreground job must not
+    wait for a background conversion to finish."""
+    finished = pyqtSignal()
+    
+    def __init__(self, *args, **kwargs):
+        super(PrerenderWorker, self).__init__(*args, **kwargs)
+        self._files = [ f for f in self._files if not os.path.isfile(self._pdfFile(f)) ]
+    
+    def hasWork(self):
+        return len(self._files) > 0
+    
+    def work(self):
+        try:
+            for f in self._files:
+                self._raiseIfCancelled()
+                try:
+                    self.generateFile(f)
+                finally:
+                    self._releaseConnections()
+        except ExportCancelledError:
+            LOGGER.debug("Prerendering cancelled")
+        except Exception as e:
+            LOGGER.debug("Prerendering failed: {}".format(e))
+        finally:
+            self._releaseConnections()
+            self.finished.emit()
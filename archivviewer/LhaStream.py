@@ -0,0 +1,96 @@
+# LhaStream.py
+
+import logging
+import lzhlib
+from lhafile import LhaFile, BadLhafile
+
+LOGGER = logging.getLogger(__name__)
+
+class _MemberReader:
+    """Read access to the compressed data of one member. Several readers may share
+    the archive file object, so every read seeks to the reader's own position."""
+    def __init__(self, fp, offset, size):
+        self._fp = fp
+        self._pos = offset
+        self._end = offset + size
+
+    def read(self, size = -1):
+        remaining = self._end - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        self._fp.seek(self._pos)
+        data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+class _OutputBuffer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+class LhaMember:
+    """One member of an LHA archive which is decompressed on demand.
+
+    peek() only inflates as much data as needed for format sniffing. The member
+    is decompressed completely only by read() or extract()."""
+    def __init__(self, fp, info):
+        self.info = info
+        self.name = info.filename
+        self.size = info.file_size
+        self._fp = fp
+        self._out = _OutputBuffer()
+        self._session = None
+        self._finished = False
+        self._consumed = 0
+
+    def _decodeNext(self):
+        if self._session is None:
+            self._session = lzhlib.LZHDecodeSession(_MemberReader(self._fp, self.info.file_offset, self.info.compress_size), self._out, self.info)
+        self._finished = self._session.do_next()
+        if self._finished:
+            if self._session.output_pos != self.size:
+                raise BadLhafile("%s output_size is not matched %d/%d %s" % (self.name, self._session.output_pos, self.size, self.info.compress_type))
+            if self._session.crc16 != self.info.CRC:
+                raise BadLhafile("crc is not matched")
+
+    def peek(self, size = 16):
+        if self._consumed > 0:
+            raise RuntimeError("peek() is only possible before reading the member")
+        while len(self._out.data) < size and not self._finished:
+            self._decodeNext()
+        return bytes(self._out.data[:size])
+
+    def extract(self, fileobj):
+        """Decompresses the member chunk by chunk into fileobj."""
+        while True:
+            if len(self._out.data) > 0:
+                fileobj.write(self._out.data)
+                self._consumed += len(self._out.data)
+                self._out.data = bytearray()
+            if self._finished:
+                break
+            self._decodeNext()
+        return self._consumed
+
+    def read(self):
+        out = _OutputBuffer()
+        self.extract(out)
+        return bytes(out.data)
+
+class LhaArchive:
+    """Lazily decoding view of an LHA archive. Only the headers are parsed on
+    construction; iterating yields one LhaMember at a time."""
+    def __init__(self, fp):
+        self._fp = fp
+        self._infos = [ info for info in LhaFile(fp).infolist() if info.compress_type != b'-lhd-' ]
+
+    def __len__(self):
+        return len(self._infos)
+
+    def __iter__(self):
+        for info in self._infos:
+            yield LhaMember(self._fp, info)
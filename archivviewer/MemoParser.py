@@ -0,0 +1,177 @@
+# MemoParser.py
+
+import io, struct
+
+class MOMask:
+    NOTUSECATEGORY = 0b00001000
+    DAYPROTOCOL = 0b00000100
+    AUTOSEND = 0b00000001
+    EMERGENCYSEND = 0b00000010
+
+_U16 = struct.Struct('<H')
+
+# The blob is read through a memoryview, so neither length fields nor category
+# entries are copied. Reads beyond the end behave like the slicing they replace:
+# missing bytes count as zero.
+
+def _u16(view, offset):
+    if offset + 2 <= len(view):
+        return _U16.unpack_from(view, offset)[0]
+    return int.from_bytes(view[offset:offset+2], 'little')
+
+def _uint(view, offset, length):
+    if length == 2:
+        return _u16(view, offset)
+    return int.from_bytes(view[offset:offset+length], 'little')
+
+def _text(view, offset, length):
+    # length includes the terminating zero byte
+    return str(view[offset:offset+length-1], 'cp1252')
+
+def parse_memo_blob(blob):
+    view = memoryview(blob)
+    categories = {}
+    offset = 0
+    totallen = _u16(view, offset)
+    offset += 2
+    # skip five leading blocks
+    for _ in range(5):
+        offset += 2 + _u16(view, offset)
+    categoriesLenRelative = _u16(view, offset)
+    offset += 2
+    categoriesLastOffset = categoriesLenRelative + offset
+    catCountLen = _u16(view, offset)
+    offset += 2
+    catCount = _uint(view, offset, catCountLen)
+    offset += catCountLen
+    while offset < categoriesLastOffset:
+        entryLen = _u16(view, offset)
+        offset += 2
+        category = parse_memo_blob_category(view[offset:offset+entryLen])
+        offset += entryLen
+        if category['useCategory']:
+            categories[category["id"]] = category
+
+    return categories
+
+def parse_memo_blob_category(blob):
+    view = memoryview(blob)
+    offset = 0
+    name = None
+    keycode = None
+    red = None
+    blue = None
+    green = None
+    auftrag = None
+    unknown6 = None
+    key2 = None
+    useCategory = True
+    dayprotocol =  True
+    autosend = False
+    emergencysend = False
+
+    b1len = _u16(view, offset)
+    offset += 2 + b1len
+    catidlen = _u16(view, offset)
+    offset += 2
+    catid = _uint(view, offset, catidlen)
+    offset += catidlen
+    kbtlen = _u16(view, offset)
+    offset += 2
+    kbt = _text(view, offset, kbtlen)
+    offset += kbtlen
+    unklen5 = _u16(view, offset)
+    offset += 2
+    if unklen5 < 20:
+        if unklen5 > 0:
+            auftrag = _text(view, offset, unklen5)
+            offset += unklen5
+        unklen3 = _u16(view, offset)
+        offset += 2 + unklen3
+        unklen4 = _u16(view, offset)
+        offset += 2
+        configbyte = 0b00000000
+        if unklen4 > 0 and offset < len(view):
+            configbyte = view[offset]
+        if configbyte & MOMask.NOTUSECATEGORY:
+            useCategory = False
+        if configbyte & MOMask.DAYPROTOCOL:
+            dayprotocol = False
+        if configbyte & MOMask.AUTOSEND:
+            autosend = True
+        if configbyte & MOMask.EMERGENCYSEND:
+            emergencysend = True
+        offset += unklen4
+        unklen6 = _u16(view, offset)
+        offset += 2
+        if unklen6 > 0:
+            unknown6 = _uint(view, offset, unklen6)
+            offset += unklen6
+        namelen = _u16(view, offset)
+        offset += 2
+        name = _text(view, offset, namelen)
+        offset += namelen
+        key2len = _u16(view, offset)
+        offset += 2
+        if key2len > 0:
+            key2 = bytes(view[offset:offset+key2len-1])
+            offset += key2len
+        keycodelen = _u16(view, offset)
+        offset += 2
+        keycode = _text(view, offset, keycodelen)
+        offset += keycodelen
+        if view[offset:offset+2] == b'\x00\x00':
+            offset += 2
+            colorlen = _u16(view, offset)
+            offset += 2
+            if colorlen == 4:
+                red = view[offset]
+                green = view[offset+1]
+                blue = view[offset+2]
+                offset += 4
+            else:
+                offset += colorlen
+
+    return { 'id': catid, 'krankenblatt': kbt,  'auftrag': auftrag,  'name': name, 'keycode': keycode, 'key2': key2, 'red': red, 'green': green,
+                'blue': blue, 'useCategory': useCategory, 'dayProtocol': dayprotocol, 'autosend': autosend, 'emergencysend': emergencysend}
+
+def parse_briefe_blob(blob):
+    """Parses FBRIEFKATEGORIELISTE, the list of letter categories."""
+    entries = []
+    offset = 0
+    totalLength =  int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    entryCountLength = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    entryCount = int.from_bytes(blob[offset:offset+entryCountLength], 'little')
+    offset += entryCountLength
+
+    while offset < len(blob):
+        entryLength = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        result = parse_briefe_entry(blob[offset:offset+entryLength])
+        entries.append(result)
+        offset += entryLength
+
+    return entries
+
+def parse_briefe_entry(blob):
+    stream = io.BytesIO(blob)
+    b1len = int.from_bytes(stream.read(2), 'little')
+    stream.read(b1len)
+    catid = None
+    namelen = int.from_bytes(stream.read(2), 'little')
+    name = stream.read(namelen)[:-1].decode('cp1252')
+    keycodelen = int.from_bytes(stream.read(2), 'little')
+    if keycodelen == 0:
+        stream.read(4)
+        keycodelen = int.from_bytes(stream.read(2), 'little')
+        keycode = stream.read(keycodelen)[:-1].decode('cp1252')
+        catidlen = int.from_bytes(stream.read(2), 'little')
+        catid = int.from_bytes(stream.read(catidlen), 'little')
+    else:
+        keycode = stream.read(keycodelen)[:-1].decode('cp1252')
+    if len(keycode) < 2:
+        keycode = ''.join(['q', keycode])
+
+    return { 'categoryId': catid, 'name': name, 'keycode': keycode }
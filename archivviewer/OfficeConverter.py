@@ -0,0 +1,180 @@
+# OfficeConverter.py
+
+import os, sys, json, subprocess, logging, queue, threading, signal
+from contextlib import contextmanager
+from pathlib import Path
+from PyQt5.QtCore import QMutex
+
+LOGGER = logging.getLogger(__name__)
+
+class OfficeConverterError(Exception):
+    pass
+
+class OfficeConverterUnavailable(OfficeConverterError):
+    """The service could not be started. This is remembered for the session, the
+    caller is expected to convert without the service."""
+    pass
+
+class OfficeConverterTimeout(OfficeConverterError):
+    """The job took too long, the service has been killed. Trying the same input
+    again is likely to hang once more."""
+    pass
+
+# queued by the reader thread once the service has closed its stdout, a timeout
+# is reported as None instead
+_EOF = object()
+
+class OfficeConverter:
+    """Keeps a headless office conversion service running in the background.
+
+    The service is a separate process speaking a line based JSON protocol on
+    stdin/stdout: it announces itself with {"ready": true} and answers every
+    {"id": n, "input": path, "output": path} job with {"id": n, "ok": bool, "error": str}.
+    For LibreOffice this is unoservice.py running on LibreOffice's bundled Python
+    interpreter, but any program implementing the protocol can be used."""
+
+    def __init__(self, command, startTimeout = 60, jobTimeout = 120):
+        self._command = command
+        self._startTimeout = startTimeout
+        self._jobTimeout = jobTimeout
+        self._mutex = QMutex()
+        self._process = None
+        self._responses = None
+        self._officePid = None
+        self._jobCounter = 0
+        self._startFailed = False
+
+    @staticmethod
+    def forLibreOffice(librepath, profiledir, name = 'soffice-service'):
+        """Returns a converter for the given soffice executable or None if the
+        installation does not ship a Python interpreter with UNO support. Every
+        converter running at the same time needs a profile name of its own."""
+        if librepath is None:
+            return None
+        programdir = os.path.dirname(librepath)
+        for interpreter in ('python.exe', 'python'):
+            python = os.path.join(programdir, interpreter)
+            if os.path.isfile(python):
+                break
+        else:
+            LOGGER.debug("No LibreOffice Python found in '{}'".format(programdir))
+            return None
+
+        if getattr(sys, 'frozen', False):
+            basedir = os.path.join(sys._MEIPASS, 'archivviewer')
+        else:
+            basedir = os.path.dirname(os.path.realpath(__file__))
+        script = os.path.join(basedir, 'unoservice.py')
+        profile = Path(profiledir, name).as_uri()
+
+        return OfficeConverter([python, script, librepath, profile])
+
+    @contextmanager
+    def lock(self):
+        self._mutex.lock()
+        try:
+            yield
+        finally:
+            self._mutex.unlock()
+
+    def available(self):
+        """False once the service has failed to start, it is not tried again."""
+        return not self._startFailed
+
+    def _readResponses(self, process, responses):
+        for line in process.stdout:
+            try:
+                responses.put(json.loads(line))
+            except ValueError:
+                LOGGER.debug("Office service: {}".format(line.rstrip()))
+        responses.put(_EOF)
+
+    def _start(self):
+        LOGGER.debug("Starting office service: {}".format(self._command))
+        creationflags = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+        try:
+            self._process = subprocess.Popen(self._command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                encoding = 'utf-8', bufsize = 1, creationflags = creationflags)
+        except OSError as e:
+            self._process = None
+            self._startFailed = True
+            raise OfficeConverterUnavailable("Konvertierungsdienst konnte nicht gestartet werden: {}".format(e))
+        self._responses = queue.Queue()
+        threading.Thread(target = self._readResponses, args = (self._process, self._responses), daemon = True).start()
+
+        response = self._waitForResponse(self._startTimeout)
+        if response is None or response is _EOF or not response.get('ready', False):
+            self._kill()
+            self._startFailed = True
+            raise OfficeConverterUnavailable("Konvertierungsdienst konnte nicht gestartet werden")
+        self._officePid = response.get('pid')
+
+    def _waitForResponse(self, timeout):
+        try:
+            return self._responses.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+    def _kill(self):
+        if self._process is not None:
+            try:
+                self._process.kill()
+                self._process.wait(5)
+            except Exception as e:
+                LOGGER.debug("Failed to kill office service: {}".format(e))
+        if self._officePid is not None:
+            # the office process is a child of the service and survives it
+            try:
+                os.kill(self._officePid, signal.SIGTERM)
+            except OSError:
+                pass
+        self._process = None
+        self._officePid = None
+        self._responses = None
+
+    def convert(self, infile, outfile, timeout = None):
+        """Converts infile to the PDF file outfile, waiting at most timeout seconds
+        (the jobTimeout by default). The service is (re)started as needed; a job
+        that crashes the service is retried once. Raises OfficeConverterUnavailable
+        right away once the service has failed to start."""
+        with self.lock():
+            if self._startFailed:
+                raise OfficeConverterUnavailable("Konvertierungsdienst ist nicht verfügbar")
+            for attempt in range(2):
+                if self._process is None or self._process.poll() is not None:
+                    self._kill()
+                    self._start()
+
+                self._jobCounter += 1
+                job = { 'id': self._jobCounter, 'input': os.path.abspath(infile), 'output': os.path.abspath(outfile) }
+                try:
+                    self._process.stdin.write(json.dumps(job) + '\n')
+                    self._process.stdin.flush()
+                    response = self._waitForResponse(self._jobTimeout if timeout is None else timeout)
+                except OSError:
+                    # the pipe is gone, the service has terminated
+                    response = _EOF
+
+                if response is _EOF:
+                    self._kill()
+                    LOGGER.info("Office service terminated unexpectedly, restarting")
+                    continue
+                if response is None:
+                    self._kill()
+                    raise OfficeConverterTimeout("Zeitüberschreitung bei der Konvertierung von '{}'".format(infile))
+
+                if response.get('id') != job['id'] or not response.get('ok', False):
+                    raise OfficeConverterError("Konvertierung von '{}' fehlgeschlagen: {}".format(infile, response.get('error')))
+                return
+
+            raise OfficeConverterError("Konvertierungsdienst ist wiederholt abgestürzt")
+
+    def stop(self):
+        with self.lock():
+            if self._process is not None and self._process.poll() is None:
+                try:
+                    self._process.stdin.close()
+                    self._process.wait(10)
+                except Exception:
+                    pass
+            self._kill()
@@ -0,0 +1,85 @@
+# PartStore.py
+
+import os, json, hashlib, logging, threading
+
+LOGGER = logging.getLogger(__name__)
+
+STORE_VERSION = 3
+
+def optionsFingerprint(options):
+    """Short digest of the conversion options, parts converted with different
+    settings must not be mixed up."""
+    encoded = json.dumps([ STORE_VERSION, options ], sort_keys = True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:12]
+
+class PartStore:
+    """Content-addressed store for converted archive parts.
+
+    Every entry is the PDF converted from one LHA member or eArztbrief attachment,
+    named after the fingerprint of the source data and the conversion options. The
+    same attachment archived several times, e.g. a forwarded letter, is thus only
+    converted once across documents, patients and sessions.
+
+    The store is nothing but its directory, so it can be handed to the export
+    worker processes. Entries are written atomically and reading one refreshes its
+    modification time, which prune() uses to evict the least recently used ones."""
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    @staticmethod
+    def key(content, options):
+        return '{}-{}-{}.pdf'.format(optionsFingerprint(options), len(content), hashlib.sha1(content).hexdigest())
+
+    def get(self, key):
+        """Returns the stored PDF for key or None."""
+        path = os.path.join(self._directory, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+
+        return data
+
+    def put(self, key, data):
+        path = os.path.join(self._directory, key)
+        tmppath = '{}.{}.{}.part'.format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self._directory, exist_ok = True)
+            with open(tmppath, 'wb') as f:
+                f.write(data)
+            os.replace(tmppath, path)
+        except OSError as e:
+            LOGGER.debug("Part store: failed to store '{}': {}".format(path, e))
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+    def prune(self, maxBytes):
+        """Removes the least recently used entries until the store is below maxBytes."""
+        entries = []
+        totalBytes = 0
+        try:
+            for entry in os.scandir(self._directory):
+                if entry.is_file() and entry.name.endswith('.pdf'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+                    totalBytes += stat.st_size
+        except OSError as e:
+            LOGGER.debug("Part store directory '{}' is not usable: {}".format(self._directory, e))
+            return
+
+        count = len(entries)
+        for (_, name, size) in sorted(entries):
+            if totalBytes <= maxBytes:
+                break
+            try:
+                os.unlink(os.path.join(self._directory, name))
+                totalBytes -= size
+                count -= 1
+            except OSError as e:
+                LOGGER.debug("Part store: failed to evict '{}': {}".format(name, e))
+        LOGGER.debug("Part store: {} entries, {} bytes".format(count, totalBytes))
@@ -0,0 +1,174 @@
+# PatientLoader.py
+
+import logging, heapq
+from PyQt5.QtCore import QObject, pyqtSignal
+from .DocumentList import DocumentList
+from .ConnectionPool import ConnectionPool
+
+LOGGER = logging.getLogger(__name__)
+
+class LoadCancelledError(Exception):
+    pass
+
+class PatientLoader(QObject):
+    """Loads the document list of a patient on a background thread.
+
+    Every request carries a generation number. Only the most recent generation
+    is worked on: requests that have been superseded while queued are skipped and
+    a running load is abandoned between queries.
+
+    The documents are delivered in pages, newest first. load() emits the first
+    page, fetchMore() continues with the open cursors of the same generation.
+    Pages are DocumentList instances.
+
+    The loader keeps its own connections checked out from the pools, as the
+    cursors stay open between pages. They are exchanged on every load."""
+    loaded = pyqtSignal(int, dict, object, dict, bool)
+    fetched = pyqtSignal(int, object, dict, bool)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, pool, arcpool, batchSize = 200, parent = None):
+        super(PatientLoader, self).__init__(parent)
+        self._pool = pool
+        self._arcpool = arcpool
+        self._con = None
+        self._arccon = None
+        self._batchSize = batchSize
+        self._latestGeneration = 0
+        self._generation = 0
+        self._rows = None
+        self._emitted = 0
+
+    def setLatestGeneration(self, generation):
+        # called from the GUI thread, a plain int assignment is atomic
+        self._latestGeneration = generation
+
+    def _checkout(self):
+        # a connection which broke while idle is replaced by the pool
+        self.releaseConnections()
+        self._con = self._pool.acquire()
+        if self._arcpool is not None:
+            self._arccon = self._arcpool.acquire()
+
+    def releaseConnections(self, broken = False):
+        if self._con is not None:
+            self._pool.release(self._con, broken)
+            self._con = None
+        if self._arccon is not None:
+            self._arcpool.release(self._arccon, broken)
+            self._arccon = None
+
+    def _raiseIfStale(self, generation):
+        if generation != self._latestGeneration:
+            raise LoadCancelledError()
+
+    def load(self, generation, infos, showRemovedItems, count):
+        self._rows = None
+        try:
+            self._raiseIfStale(generation)
+            self._generation = generation
+            self._emitted = 0
+            self._checkout()
+            self._rows = self._openRows(generation, int(infos["id"]), showRemovedItems)
+            files, categoryIndex, hasMore = self._nextPage(generation, count)
+            self.loaded.emit(generation, infos, files, categoryIndex, hasMore)
+        except LoadCancelledError:
+            self._rows = None
+            LOGGER.debug("Discarding outdated load of patient {}".format(infos.get("id")))
+        except Exception as e:
+            self._rows = None
+            self.releaseConnections(ConnectionPool.isDatabaseError(e))
+            LOGGER.debug("Loading patient {} failed: {}".format(infos.get("id"), e))
+            self.failed.emit(generation, str(e))
+
+    def fetchMore(self, generation, count):
+        """Emits the next count documents of the current load, all remaining ones if
+        count is negative."""
+        if generation != self._generation or self._rows is None:
+            return
+
+        try:
+            self._raiseIfStale(generation)
+            files, categoryIndex, hasMore = self._nextPage(generation, count)
+            self.fetched.emit(generation, files, categoryIndex, hasMore)
+        except LoadCancelledError:
+            self._rows = None
+            LOGGER.debug("Discarding outdated load")
+        except Exception as e:
+            self._rows = None
+            self.releaseConnections(ConnectionPool.isDatabaseError(e))
+            LOGGER.debug("Fetching documents failed: {}".format(e))
+            self.failed.emit(generation, str(e))
+
+    def _nextPage(self, generation, count):
+        files = DocumentList()
+        if count != 0:
+            for row in self._rows:
+                files.append(*row)
+                if len(files) == count:
+                    break
+            else:
+                self._rows = None
+
+        categoryIndex = self._indexByCategory(files, self._emitted)
+        self._emitted += len(files)
+
+        return files, categoryIndex, self._rows is not None
+
+    def _openRows(self, generation, patnr, showRemovedItems):
+        """Returns an iterator over the documents of both databases, merged by date.
+        Both queries are sorted already, so the rows can be streamed."""
+        stmParts = [ "SELECT a.FSUROGAT, a.FTEXT, a.FEINTRAGSART, a.FZEIT, a.FDATUM FROM ARCHIV a WHERE" ]
+        if not showRemovedItems:
+            stmParts.append("EXISTS (SELECT 1 FROM LTAG l WHERE a.FSUROGAT = l.FEINTRAGSNR AND a.FEINTRAGSART = l.FEINTRAGSART) AND")
+        stmParts.append("a.FPATNR = ? AND a.FEINTRAGSART > 0 ORDER BY a.FDATUM DESC, a.FZEIT DESC")
+
+        sources = [ self._fetchRows(generation, self._con, ' '.join(stmParts), patnr) ]
+
+        if self._arccon is not None:
+            selectStm = "SELECT a.FSUROGAT, a.FTEXT, a.FEINTRAGSART, a.FZEIT, a.FDATUM FROM ARCHIV a WHERE a.FPATNR = ? AND a.FEINTRAGSART > 0 ORDER BY a.FDATUM DESC, a.FZEIT DESC"
+            sources.append(self._fetchRows(generation, self._arccon, selectStm, patnr, medoffarc = True, checkLtag = not showRemovedItems))
+
+        return heapq.merge(*sources, key = lambda x: (x[4], x[3]), reverse = True)
+
+    def _fetchRows(self, generation, con, selectStm, patnr, medoffarc = False, checkLtag = False):
+        cur = con.cursor()
+        cur.execute(selectStm, (patnr,))
+
+        while True:
+            self._raiseIfStale(generation)
+            rows = cur.fetchmany(self._batchSize)
+            if len(rows) == 0:
+                break
+
+            if checkLtag:
+                existing = self._existingLtagEntries(set(row[0] for row in rows))
+                rows = [ row for row in rows if (row[0], row[2]) in existing ]
+
+            for (surogat, beschreibung, eintragsart, zeit, datum) in rows:
+                yield (surogat, beschreibung, eintragsart, zeit, datum, medoffarc)
+
+    @staticmethod
+    def _indexByCategory(files, start = 0):
+        """Returns a dict mapping each FEINTRAGSART to the ascending row numbers of its
+        documents in files, i.e. every bucket keeps the date order of the list.
+        Row numbers are counted from start."""
+        index = {}
+        for (row, category) in enumerate(files.categories, start):
+            index.setdefault(category, []).append(row)
+        
+        return index
+    
+    def _existingLtagEntries(self, surogats, chunksize = 500):
+        """Returns the (FEINTRAGSNR, FEINTRAGSART) pairs of LTAG for the given entry numbers,
+        queried in chunks instead of one statement per entry."""
+        existing = set()
+        surogats = list(surogats)
+        cur = self._con.cursor()
+        for start in range(0, len(surogats), chunksize):
+            chunk = surogats[start:start+chunksize]
+            selectStm = "SELECT l.FEINTRAGSNR, l.FEINTRAGSART FROM LTAG l WHERE l.FEINTRAGSNR IN ({})".format(', '.join([ '?' ] * len(chunk)))
+            cur.execute(selectStm, chunk)
+            existing.update((nr, art) for (nr, art) in cur)
+
+        return existing
@@ -0,0 +1,134 @@
+# PdfCache.py
+
+import os, shutil, logging
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+from PyQt5.QtCore import QMutex
+from .configreader import ConfigReader
+from .PartStore import optionsFingerprint
+
+LOGGER = logging.getLogger(__name__)
+
+def blobFingerprint(length, sha1digest):
+    return '{}-{}'.format(length, sha1digest)
+
+class PdfCache:
+    """Persistent on-disk cache for rendered PDF files. Entries are evicted in
+    least-recently-used order once the configured byte limit is exceeded."""
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if PdfCache.__instance == None:
+            with threading.Lock():
+                if PdfCache.__instance == None:
+                    PdfCache()
+        return PdfCache.__instance
+
+    def __init__(self):
+        if PdfCache.__instance != None:
+            raise Exception("This is a singleton class, don't instantiate it directly!")
+        else:
+            PdfCache.__instance = self
+
+        config = ConfigReader.get_instance()
+        defaultdir = os.sep.join([os.environ.get("LocalAppData", os.environ["AppData"]), "ArchivViewer", "cache"])
+        self._directory = config.getValue('pdfCacheDir', defaultdir)
+        self._maxBytes = config.getValue('pdfCacheMaxBytes', 1024*1024*1024)
+        self._mutex = QMutex()
+        self._entries = OrderedDict()
+        self._totalBytes = 0
+        self._scanDirectory()
+
+    @contextmanager
+    def lock(self):
+        self._mutex.lock()
+        try:
+            yield
+        finally:
+            self._mutex.unlock()
+
+    @staticmethod
+    def key(database, id, fingerprint, options):
+        """The conversion options are part of the key, so changing a setting takes
+        effect for documents which have been cached before."""
+        return '{}-{}-{}-{}.pdf'.format(database, id, fingerprint, optionsFingerprint(options))
+
+    def _scanDirectory(self):
+        try:
+            os.makedirs(self._directory, exist_ok = True)
+            entries = []
+            for entry in os.scandir(self._directory):
+                if entry.is_file() and entry.name.endswith('.pdf'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+        except OSError as e:
+            LOGGER.info("PDF cache directory '{}' is not usable: {}".format(self._directory, e))
+            self._maxBytes = 0
+            return
+
+        for (_, name, size) in sorted(entries):
+            self._entries[name] = size
+            self._totalBytes += size
+        LOGGER.debug("PDF cache: {} entries, {} bytes".format(len(self._entries), self._totalBytes))
+        self._evict()
+
+    def get(self, key, destination):
+        """Copy the cached PDF for key to destination. Returns False on a cache miss."""
+        with self.lock():
+            if key not in self._entries:
+                return False
+            self._entries.move_to_end(key)
+
+        path = os.path.join(self._directory, key)
+        tmpdestination = '{}.{}.part'.format(destination, threading.get_ident())
+        try:
+            shutil.copyfile(path, tmpdestination)
+            os.replace(tmpdestination, destination)
+            os.utime(path)
+        except OSError as e:
+            LOGGER.debug("PDF cache: failed to read '{}': {}".format(path, e))
+            with self.lock():
+                self._discard(key)
+            return False
+
+        return True
+
+    def put(self, key, sourcefile):
+        if self._maxBytes <= 0:
+            return
+
+        path = os.path.join(self._directory, key)
+        tmppath = '{}.{}.part'.format(path, threading.get_ident())
+        try:
+            shutil.copyfile(sourcefile, tmppath)
+            os.replace(tmppath, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            LOGGER.debug("PDF cache: failed to store '{}': {}".format(path, e))
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            return
+
+        with self.lock():
+            self._discard(key)
+            self._entries[key] = size
+            self._totalBytes += size
+            self._evict()
+
+    def _discard(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._totalBytes -= size
+
+    def _evict(self):
+        while self._totalBytes > self._maxBytes and len(self._entries) > 0:
+            key, size = self._entries.popitem(last = False)
+            self._totalBytes -= size
+            try:
+                os.unlink(os.path.join(self._directory, key))
+            except OSError as e:
+                LOGGER.debug("PDF cache: failed to evict '{}': {}".format(key, e))
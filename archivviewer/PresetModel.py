@@ -28,11 +28,12 @@ class PresetModel(QAbstractItemModel):
         return self._presets[idx]['categories']
     
     def setSelectedCategories(self, idx, categories):
-        self._presets[idx]['categories'] = categories
+        self._presets[idx] = { **self._presets[idx], 'categories': list(categories) }
         self._savePresets()
     
     def _savePresets(self):
-        self._config.setValue("categoryPresets", tuple(filter(lambda x: len(x["name"]) > 0, self._presets[1:])))
+        # the presets are our own copy, the configuration only changes here
+        self._config.setValue("categoryPresets", [ preset for preset in self._presets[1:] if len(preset["name"]) > 0 ])
     
     def index(self, row, column, parent):
         if row < self.rowCount(parent) and column == 0:
@@ -78,7 +79,7 @@ class PresetModel(QAbstractItemModel):
         return True
         
     def setData(self, index, value, role):
-        self._presets[index.row()]["name"] = value
+        self._presets[index.row()] = { **self._presets[index.row()], 'name': value }
         self._savePresets()
         self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
         
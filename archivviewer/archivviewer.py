@@ -1,15 +1,16 @@
 # Archivviewer.py
 
-import sys, codecs, os, fdb, json, tempfile, shutil, subprocess, io, winreg, configparser, email, logging
+import sys, codecs, os, fdb, json, tempfile, shutil, subprocess, io, winreg, configparser, email, logging, heapq, hashlib, threading, functools
 from subprocess import PIPE
 from datetime import datetime, timedelta
 from collections import OrderedDict
+from array import array
 import collections
 from contextlib import contextmanager
 from pathlib import Path
 from PyPDF2 import PdfFileMerger
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QFileDialog, QStyle
-from PyQt5.QtCore import QAbstractTableModel, Qt, QThread, pyqtSignal, pyqtSlot, QObject, QTranslator, QLocale, QLibraryInfo, QEvent, QSettings, QItemSelectionModel, QItemSelection, QItemSelectionRange
+from PyQt5.QtCore import QAbstractTableModel, Qt, QThread, pyqtSignal, pyqtSlot, QObject, QTranslator, QLocale, QLibraryInfo, QEvent, QSettings, QItemSelectionModel, QItemSelection, QItemSelectionRange, QModelIndex
 from PyQt5.QtGui import QColor, QBrush, QIcon
 from PyQt5.QtWinExtras import QWinTaskbarProgress, QWinTaskbarButton
 from watchdog.observers import Observer
@@ -19,7 +20,11 @@ from .configreader import ConfigReader
 from .CategoryModel import CategoryModel
 from .PresetModel import PresetModel
 from .FilesTableDelegate import FilesTableDelegate
-from .GenerateFileWorker import GenerateFileWorker
+from .GenerateFileWorker import GenerateFileWorker, PrerenderWorker
+from .OfficeConverter import OfficeConverter
+from .PatientLoader import PatientLoader
+from .DocumentList import DocumentList
+from .ConnectionPool import ConnectionPool
 
 logging.basicConfig(level=logging.INFO)
 LOGGER = logging.getLogger(__name__)
@@ -29,10 +34,10 @@ def displayErrorMessage(msg):
     QMessageBox.critical(None, "Fehler", str(msg))
 
 class ArchivViewer(QMainWindow, ArchivviewerUi):
-    def __init__(self, con, parent = None):
+    def __init__(self, pool, parent = None):
         super(ArchivViewer, self).__init__(parent)
         self._config = ConfigReader.get_instance()
-        self._con = con
+        self._pool = pool
         self.taskbar_button = None
         self.taskbar_progress = None
         self.setupUi(self)
@@ -61,7 +66,7 @@ class ArchivViewer(QMainWindow, ArchivviewerUi):
         self.savePreset.clicked.connect(self.savePresetClicked)
         self.presets.currentIndexChanged.connect(self.presetsIndexChanged)
         try:
-            self.categoryListModel = CategoryModel(self._con)
+            self.categoryListModel = CategoryModel(self._pool)
         except Exception as e:
             displayErrorMessage("Fehler beim Laden der Kategorien: {}".format(e))
             sys.exit()
@@ -110,14 +115,7 @@ class ArchivViewer(QMainWindow, ArchivviewerUi):
         self.clearPreset.setEnabled(idx > 0)
         categories = self.presetModel.categoriesAtIndex(idx)
         selm = self.categoryList.selectionModel()
-        cmodel = self.categoryList.model()
-        catidxs = [ cmodel.createIndex(row, 0, None) for row in range(cmodel.rowCount(None)) ]
-        
-        qis = QItemSelection()
-        for cidx in catidxs:
-            if cmodel.idAtRow(cidx.row()) in categories:
-                qir = QItemSelectionRange(cidx)
-                qis.append(qir)
+        qis = self.categoryList.model().selectionForIds(categories)
         selm.select(qis, QItemSelectionModel.ClearAndSelect)
     
     def categoryListModelDataChanged(self, begin, end):
@@ -173,42 +171,97 @@ class ArchivViewer(QMainWindow, ArchivviewerUi):
             pass
         
 class FileChangeHandler(FileSystemEventHandler):
+    """Watches the GDT file. Medical Office writes it in several steps, so events
+    are coalesced and the file is only parsed if its content changed. A reload is
+    only triggered when the file names another patient."""
     def __init__(self, gdtfile, model):
         super().__init__()
         self.gdtfile = gdtfile
         self.model = model
+        self._delay = ConfigReader.get_instance().getValue('gdtDebounceMs', 300) / 1000
+        self._timer = None
+        self._timerLock = threading.Lock()
+        self._stat = None
+        self._digest = None
+        self._patient = None
+    
+    def setActivePatient(self, infos):
+        self._patient = gdtIdentity(infos)
     
     def on_modified(self, event):
         if self.gdtfile == event.src_path:
-            infos = readGDT(self.gdtfile)
+            with self._timerLock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(self._delay, self._checkFile)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def stop(self):
+        with self._timerLock:
+            if self._timer is not None:
+                self._timer.cancel()
+    
+    def _checkFile(self):
+        try:
+            stat = os.stat(self.gdtfile)
+            if (stat.st_mtime_ns, stat.st_size) == self._stat:
+                return
+            with open(self.gdtfile, 'rb') as f:
+                content = f.read()
+            self._stat = (stat.st_mtime_ns, stat.st_size)
+            digest = hashlib.sha1(content).digest()
+            if digest == self._digest:
+                return
+            self._digest = digest
+            
+            infos = parseGDT(content.decode('iso-8859-15').splitlines(keepends = True))
+            patient = gdtIdentity(infos)
             try:
-                patid = int(infos["id"])
+                int(infos["id"])
+                complete = None not in patient
+            except (TypeError, ValueError):
+                complete = False
+            if not complete:
+                # the next write triggers another check
+                return
+            
+            if patient != self._patient:
+                self._patient = patient
                 self.model.activePatientChanged.emit(infos)
-                
-            except TypeError:
-                pass
+        except Exception as e:
+            LOGGER.debug("Failed to read GDT file '{}': {}".format(self.gdtfile, e))
 
 class ArchivTableModel(QAbstractTableModel):    
     _startDate = datetime(1890, 1, 1)
     _dataReloaded = pyqtSignal()
+    _loadRequested = pyqtSignal(int, dict, bool, int)
+    _fetchRequested = pyqtSignal(int, int)
     activePatientChanged = pyqtSignal(dict)
 
-    def __init__(self, con, arccon, tmpdir, librepath, mainwindow, application, gimppath, gspath):
+    def __init__(self, pool, arcpool, tmpdir, librepath, mainwindow, application, gimppath, gspath, office = None, prerenderOffice = None):
         super(ArchivTableModel, self).__init__()
-        self._unfilteredFiles = []
-        self._files = []
-        self._con = con
-        self._arccon = arccon
+        self._documents = DocumentList()
+        self._categoryIndex = {}
+        self._categoryCache = {}
+        self._rows = array('l')
+        self._pool = pool
+        self._arcpool = arcpool
         self._tmpdir = tmpdir
         self._librepath = librepath
         self._table = mainwindow.documentView
         self._av = mainwindow
         self._application = application
         self._infos = {}
+        # patient whose documents are in the model, self._infos may already be the next one
+        self._displayedInfos = {}
         self._generateFileWorker = None
         self._categoryModel = self._av.categoryListModel
+        self._categoryModel.modelReset.connect(self.categoriesReset)
         self._gimppath = gimppath
         self._categoryFilter = set()
+        self._filterText = ''
+        self._rowsQuery = None
         self._av.categoryList.selectionModel().selectionChanged.connect(self.categorySelectionChanged)
         self._av.filterDescription.textEdited.connect(self.filterTextChanged)
         self._config = ConfigReader.get_instance()
@@ -219,8 +272,27 @@ class ArchivTableModel(QAbstractTableModel):
         self._av.cancelExport.hide()
         self._av.cancelExport.clicked.connect(self.cancelExport)
         self._gspath = gspath
+        self._office = office
+        self._prerenderOffice = prerenderOffice
         self.activePatientChanged.connect(self.setActivePatient)
         self.generateFileThread = None      
+        self._loadGeneration = 0
+        self._loading = False
+        self._resetFilterOnLoad = False
+        self._pageSize = self._config.getValue('documentPageSize', 200)
+        self._hasMore = False
+        self._fetching = False
+        self._exportAllPending = False
+        self._loader = PatientLoader(pool, arcpool, batchSize = self._pageSize)
+        self._loaderThread = QThread()
+        self._loader.moveToThread(self._loaderThread)
+        self._loadRequested.connect(self._loader.load)
+        self._fetchRequested.connect(self._loader.fetchMore)
+        self._loader.loaded.connect(self.patientLoaded)
+        self._loader.fetched.connect(self.pageFetched)
+        self._loader.failed.connect(self.patientLoadFailed)
+        self._loaderThread.start()
+        self._prerenderJobs = []
     
     def __del__(self):
         if self.generateFileThread:
@@ -228,9 +300,7 @@ class ArchivTableModel(QAbstractTableModel):
         
     def showRemovedItemsChanged(self):
         self._config.setValue("showRemovedItems", self._av.actionShowRemovedItems.isChecked())
-        self.beginResetModel()
         self.reloadData()
-        self.endResetModel()
         
     def categorySelectionChanged(self, selected, deselected):
         for idx in selected.indexes():
@@ -239,95 +309,167 @@ class ArchivTableModel(QAbstractTableModel):
         for idx in deselected.indexes():
             id = self._categoryModel.idAtRow(idx.row())
             self._categoryFilter.discard(id)
-                
+        
+        self._rowsQuery = None
         self.applyFilters()
     
-    def filterTextChanged(self, _):
+    def filterTextChanged(self, text):
+        self._filterText = text.lower()
         self.applyFilters()
     
     def applyFilters(self):
         self.beginResetModel()
         self._applyFilters()
         self.endResetModel()
+        if len(self._rows) < self._pageSize:
+            # keep streaming in documents while the filtered list is short
+            self.fetchMore(QModelIndex())
                 
     def _applyFilters(self):
+        query = self._filterText
+        if self._rowsQuery is not None and self._rowsQuery in query:
+            # every match of the new query is already part of the current result
+            rows = self._rows
+        else:
+            if len(self._categoryFilter) > 0:
+                # merge the date ordered rows of the selected categories only
+                buckets = [ self._categoryIndex[c] for c in self._categoryFilter if c in self._categoryIndex ]
+                rows = array('l', heapq.merge(*buckets))
+            else:
+                rows = array('l', range(len(self._documents)))
+        
+        if len(query) > 0:
+            searchkeys = self._documents.searchKeys()
+            rows = array('l', (row for row in rows if query in searchkeys[row]))
         
-        self._files = list(filter(lambda x: 
-                                 (len(self._categoryFilter) == 0 or x['category'] in self._categoryFilter)
-                                 and (len(self._av.filterDescription.text()) == 0 or self._av.filterDescription.text().lower() in x['beschreibung'].lower()), self._unfilteredFiles))
+        self._rows = rows
+        self._rowsQuery = query
+    
+    def _filterPage(self, start, end):
+        query = self._filterText
+        categories = self._documents.categories
+        rows = ( row for row in range(start, end) if len(self._categoryFilter) == 0 or categories[row] in self._categoryFilter )
+        if len(query) > 0:
+            searchkeys = self._documents.searchKeys()
+            rows = ( row for row in rows if query in searchkeys[row] )
+        return array('l', rows)
     
     def endResetModel(self):
         QAbstractTableModel.endResetModel(self)
+        self._updateView()
+    
+    def endInsertRows(self):
+        QAbstractTableModel.endInsertRows(self)
+        self._updateView()
+    
+    def _updateView(self):
         self._table.resizeColumnsToContents()
         self._table.horizontalHeader().setStretchLastSection(True)
-        hasFiles = len(self._files) > 0
+        hasFiles = len(self._rows) > 0
         self._table.horizontalHeader().setVisible(hasFiles)
         self._av.exportPdf.setEnabled(hasFiles)
     
     def updateLabel(self):
         
-        unb = self._infos["birthdate"]
-        newinfos =  { **self._infos, 'birthdate': '{}.{}.{}'.format(unb[0:2], unb[2:4], unb[4:8]) }
+        unb = self._displayedInfos["birthdate"]
+        newinfos =  { **self._displayedInfos, 'birthdate': '{}.{}.{}'.format(unb[0:2], unb[2:4], unb[4:8]) }
         labeltext = '{id}, {name}, {surname}, *{birthdate}'.format(**newinfos)
         self._av.patientName.setText(labeltext)
         self._av.setWindowTitle('Archiv Viewer - {}'.format(labeltext))
         
     def setActivePatient(self, infos):
-        self.beginResetModel()
-        
         self._infos = infos
-        unb = infos["birthdate"]
-        newinfos =  { **infos, 'birthdate': '{}.{}.{}'.format(unb[0:2], unb[2:4], unb[4:8]) }
-            
-        self.reloadData()
+        if gdtIdentity(infos) != gdtIdentity(self._displayedInfos):
+            self._clearDocuments(infos)
+        self.reloadData(resetFilter = True)
+    
+    def _clearDocuments(self, infos):
+        """Empties the model when switching patients, the documents of the previous
+        patient must neither be shown nor be exported under the new patient's name."""
+        self.beginResetModel()
+        self._documents = DocumentList()
+        self._categoryIndex = {}
+        self._rows = array('l')
+        self._rowsQuery = None
+        self._hasMore = False
+        self._fetching = False
+        self._displayedInfos = infos
         self.endResetModel()
-        self._av.refreshFiles.setEnabled(True)
-        self._dataReloaded.emit()
+        if infos.get("birthdate") is not None:
+            self.updateLabel()
     
     def data(self, index, role):
+        # everything is looked up from the render caches, no locking or formatting here
         if role == Qt.DisplayRole:
-            file = self._files[index.row()]
+            row = self._rows[index.row()]
             col = index.column()
             
             if col == 0:
-                return file["datum"].strftime('%d.%m.%Y')
+                return self._documents.datelabels[row]
             elif col == 1:
-                return file["datum"].strftime('%H:%M')
+                return self._documents.timelabels[row]
             elif col == 2:
-                try:
-                    return self._categoryModel.categoryById(file["category"])['krankenblatt']
-                except KeyError:
-                    return file["category"]
+                return self._categoryCache[self._documents.categories[row]][0]
             elif col == 3:
-                return file["beschreibung"]
+                return self._documents.descriptions[row]
         elif role == Qt.BackgroundRole:
-            file = self._files[index.row()]
-            col = index.column()
-            if col == 2:
-                try:
-                    colors = self._categoryModel.colorById(file["category"]) 
-                    if colors['red'] is not None:
-                        return QBrush(QColor.fromRgb(colors['red'], colors['green'], colors['blue']))
-                except KeyError:
-                    pass
+            if index.column() == 2:
+                return self._categoryCache[self._documents.categories[self._rows[index.row()]]][2]
         elif role == Qt.ToolTipRole:
             col = index.column()
             
-            file = self._files[index.row()]
+            row = self._rows[index.row()]
             if col == 2:
-                try:
-                    return self._categoryModel.categoryById(file["category"])['name']
-                except KeyError:
-                    return "(unbekannte Kategorie)"
+                return self._categoryCache[self._documents.categories[row]][1]
             elif col == 3:
-                return file["beschreibung"]
+                return self._documents.descriptions[row]
         elif role == Qt.TextAlignmentRole:
             if index.column() == 2:
                 return Qt.AlignCenter
+    
+    def _cacheCategories(self, categories):
+        """Fills the render cache with the label, tooltip and background brush of the
+        given categories. A brush is shared by all rows of its category."""
+        for category in categories:
+            if category in self._categoryCache:
+                continue
+            
+            try:
+                cat = self._categoryModel.categoryById(category)
+                label, tooltip = cat['krankenblatt'], cat['name']
+            except KeyError:
+                label, tooltip = category, "(unbekannte Kategorie)"
             
+            brush = None
+            try:
+                colors = self._categoryModel.colorById(category)
+                if colors['red'] is not None:
+                    brush = QBrush(QColor.fromRgb(colors['red'], colors['green'], colors['blue']))
+            except KeyError:
+                pass
+            
+            self._categoryCache[category] = (label, tooltip, brush)
+    
+    def categoriesReset(self):
+        self._categoryCache = {}
+        self._cacheCategories(self._categoryIndex.keys())
+        if len(self._rows) > 0:
+            self.dataChanged.emit(self.index(0, 2), self.index(len(self._rows) - 1, 2))
+    
     def rowCount(self, index):
-        rc = len(self._files)
+        rc = len(self._rows)
         return rc
+    
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self._hasMore and not self._fetching and not self._loading
+    
+    def fetchMore(self, parent):
+        if self.canFetchMore(parent):
+            self._requestPage(self._pageSize)
+    
+    def _requestPage(self, count):
+        self._fetching = True
+        self._fetchRequested.emit(self._loadGeneration, count)
         
     def columnCount(self, index):
         return 4
@@ -345,65 +487,134 @@ class ArchivTableModel(QAbstractTableModel):
                 elif section == 3:
                     return "Beschreibung"
     
-    def reloadData(self):
+    def reloadData(self, resetFilter = False):
+        """Starts loading the documents of the active patient in the background.
+        Loads which are still pending are superseded by this one."""
         patnr = None
         try:
             patnr = int(self._infos["id"])
-        except KeyError:
+        except (KeyError, TypeError):
             pass
         
         if patnr is not None:
-            self._application.setOverrideCursor(Qt.WaitCursor)
+            self._cancelPrerender()
+            self._cancelExportAll()
+            self._loadGeneration += 1
+            self._resetFilterOnLoad = self._resetFilterOnLoad or resetFilter
+            self._loader.setLatestGeneration(self._loadGeneration)
+            if not self._loading:
+                self._loading = True
+                self._application.setOverrideCursor(Qt.BusyCursor)
+            self._loadRequested.emit(self._loadGeneration, self._infos, self._config.getValue("showRemovedItems", False), self._pageSize)
+    
+    def patientLoaded(self, generation, infos, files, categoryIndex, hasMore):
+        if generation != self._loadGeneration:
+            return
         
-            self._unfilteredFiles = []
-            
-            stmParts = [ "SELECT a.FSUROGAT, a.FTEXT, a.FEINTRAGSART, a.FZEIT, a.FDATUM FROM ARCHIV a WHERE" ]
-            if not self._config.getValue("showRemovedItems", False):
-                stmParts.append("EXISTS (SELECT 1 FROM LTAG l WHERE a.FSUROGAT = l.FEINTRAGSNR AND a.FEINTRAGSART = l.FEINTRAGSART) AND")
-            stmParts.append("a.FPATNR = ? AND a.FEINTRAGSART > 0 ORDER BY a.FDATUM DESC, a.FZEIT DESC")
-            
-            selectStm = ' '.join(stmParts)
-            cur = self._con.cursor()
-            cur.execute(selectStm, (patnr,))
-            
-            for (surogat, beschreibung, eintragsart, zeit, datum) in cur:
-                self._unfilteredFiles.append({
-                    'id': surogat,
-                    'datum': self._startDate + timedelta(days = datum, seconds = zeit),
-                    'beschreibung': beschreibung,
-                    'category': eintragsart
-                })
-            
-            if self._arccon is not None:
-                selectStm = "SELECT a.FSUROGAT, a.FTEXT, a.FEINTRAGSART, a.FZEIT, a.FDATUM FROM ARCHIV a WHERE a.FPATNR = ? AND a.FEINTRAGSART > 0 ORDER BY a.FDATUM DESC, a.FZEIT DESC"
-                cur = self._arccon.cursor()
-                cur.execute(selectStm, (patnr,))
-                
-                added = False
-                for (surogat, beschreibung, eintragsart, zeit, datum) in cur:
-                    add = True
-                    if not self._config.getValue("showRemovedItems", False):
-                        select2 = "SELECT COUNT(*) FROM LTAG l WHERE l.FEINTRAGSNR = ? AND l.FEINTRAGSART = ?"
-                        cur2 = self._con.cursor()
-                        cur2.execute(select2, (surogat, eintragsart))
-                        if cur2.fetchone()[0] == 0:
-                            add = False
-                    
-                    if add:
-                        added = True
-                        self._unfilteredFiles.append({
-                            'id': surogat,
-                            'datum': self._startDate + timedelta(days = datum, seconds = zeit),
-                            'beschreibung': beschreibung,
-                            'category': eintragsart,
-                            'medoffarc': True
-                        })
-            
-            self._unfilteredFiles.sort(key = lambda x: x['datum'], reverse = True)
-            
-            self._applyFilters()
-            
+        self._finishLoading()
+        self.beginResetModel()
+        self._displayedInfos = infos
+        self._hasMore = hasMore
+        self._fetching = False
+        self._documents = files
+        self._categoryIndex = categoryIndex
+        self._cacheCategories(categoryIndex.keys())
+        self._rowsQuery = None
+        if self._resetFilterOnLoad:
+            self._av.filterDescription.clear()
+            self._filterText = ''
+        self._applyFilters()
+        self.endResetModel()
+        self._av.refreshFiles.setEnabled(True)
+        if self._resetFilterOnLoad:
+            self._resetFilterOnLoad = False
+            self._dataReloaded.emit()
+        self._startPrerender()
+    
+    def pageFetched(self, generation, files, categoryIndex, hasMore):
+        if generation != self._loadGeneration:
+            return
+        
+        self._fetching = False
+        self._hasMore = hasMore
+        start = len(self._documents)
+        self._documents.extend(files)
+        for (category, rows) in categoryIndex.items():
+            self._categoryIndex.setdefault(category, []).extend(rows)
+        self._cacheCategories(categoryIndex.keys())
+        
+        # fetched rows are older than all loaded ones, so matches are appended at the end
+        visible = self._filterPage(start, len(self._documents))
+        if len(visible) > 0:
+            first = len(self._rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(visible) - 1)
+            self._rows.extend(visible)
+            self.endInsertRows()
+        
+        if self._exportAllPending:
+            if not hasMore:
+                self._cancelExportAll()
+                self.exportAsPdf(range(len(self._rows)))
+        elif len(visible) == 0 and hasMore:
+            # the view only asks for more rows when it has got new ones
+            self._requestPage(self._pageSize)
+    
+    def _cancelExportAll(self):
+        if self._exportAllPending:
+            self._exportAllPending = False
             self._application.restoreOverrideCursor()
+    
+    def patientLoadFailed(self, generation, message):
+        if generation != self._loadGeneration:
+            return
+        
+        self._finishLoading()
+        self._cancelExportAll()
+        self._hasMore = False
+        self._fetching = False
+        self._resetFilterOnLoad = False
+        self._av.refreshFiles.setEnabled(True)
+        self._av.displayErrorMessage("Fehler beim Laden der Dokumente: {}".format(message))
+    
+    def _finishLoading(self):
+        if self._loading:
+            self._loading = False
+            self._application.restoreOverrideCursor()
+    
+    def _startPrerender(self):
+        """Renders the newest documents of the patient in the background with low priority,
+        they are the ones most likely to be opened next."""
+        self._cancelPrerender()
+        count = self._config.getValue('prerenderCount', 5)
+        if count <= 0 or self.generateFileThread is not None or len(self._rows) == 0:
+            return
+        
+        files = [ self._documents.document(row) for row in self._rows[:count] ]
+        worker = PrerenderWorker(self._tmpdir, files, self._pool, self._arcpool, self._librepath, self._gimppath, self._gspath, office = self._prerenderOffice)
+        if not worker.hasWork():
+            # e.g. after a refresh, everything has been rendered already
+            return
+        thread = QThread()
+        worker.moveToThread(thread)
+        job = (thread, worker)
+        thread.started.connect(worker.work)
+        worker.finished.connect(thread.quit)
+        thread.finished.connect(lambda: self._prerenderJobs.remove(job))
+        self._prerenderJobs.append(job)
+        thread.start(QThread.LowestPriority)
+    
+    def _cancelPrerender(self):
+        for (_, worker) in self._prerenderJobs:
+            worker.cancel()
+    
+    def shutdown(self):
+        self._cancelPrerender()
+        for (thread, _) in list(self._prerenderJobs):
+            thread.wait()
+        self._loader.setLatestGeneration(-1)
+        self._loaderThread.quit()
+        self._loaderThread.wait()
+        self._loader.releaseConnections()
         
     def displayFile(self, rowIndex):
         self.exportAsPdf([ rowIndex ], False)
@@ -459,7 +670,7 @@ class ArchivTableModel(QAbstractTableModel):
         self._av.exportProgress.setEnabled(False)
         self._av.exportPdf.show()
         self._av.cancelExport.hide()
-        self._av.exportPdf.setEnabled(len(self._files)>0)
+        self._av.exportPdf.setEnabled(len(self._rows)>0)
         self._av.documentView.setEnabled(True)
         self._av.categoryList.setEnabled(True)
         self._av.filterDescription.setEnabled(True)
@@ -470,19 +681,24 @@ class ArchivTableModel(QAbstractTableModel):
         self.generateFileThread.wait()
         self.generateFileThread = None
         self._generateFileWorker = None
+        self._startPrerender()
     
-    def exportCompleted(self, filename, counter, failed, errors, isExport):
+    def exportCompleted(self, filename, counter, failed, errors, isExport, stats):
         destination = filename
         
         self.exportCancelled()
         
+        dedupe = ""
+        if stats.get('dedupeHits', 0) > 0:
+            dedupe = "\n\n%d Dokumentteile wurden aus dem Konvertierungsspeicher übernommen (%.1f MB)" % (stats['dedupeHits'], stats['dedupeBytes'] / 1024 / 1024)
+        
         success = False
         if isExport:
             if failed == 0:
-                QMessageBox.information(self._av, "Export abgeschlossen", "%d Dokumente wurden nach '%s' exportiert" % (counter, destination))
+                QMessageBox.information(self._av, "Export abgeschlossen", "%d Dokumente wurden nach '%s' exportiert%s" % (counter, destination, dedupe))
                 success = True
             elif failed < counter:
-                message = '\n'.join([ "%d von %d Dokumenten wurden nach '%s' exportiert\n\nWährend des Exports sind Fehler aufgetreten:\n" % (counter-failed, counter, destination), *errors ])
+                message = '\n'.join([ "%d von %d Dokumenten wurden nach '%s' exportiert%s\n\nWährend des Exports sind Fehler aufgetreten:\n" % (counter-failed, counter, destination, dedupe), *errors ])
                 QMessageBox.warning(self._av, "Export abgeschlossen", message)
                 success = True
             else:
@@ -507,22 +723,28 @@ class ArchivTableModel(QAbstractTableModel):
         if len(filelist) == 0 and doExport:
             buttonReply = QMessageBox.question(self._av, 'PDF-Export', "Kein Dokument ausgewählt. Export aus allen angezeigten Dokumenten des Patienten erzeugen?", QMessageBox.Yes | QMessageBox.No)
             if(buttonReply == QMessageBox.Yes):
-                filelist = range(len(self._files))
+                if self._hasMore:
+                    # fetch the remaining documents of the patient first
+                    self._exportAllPending = True
+                    self._application.setOverrideCursor(Qt.WaitCursor)
+                    self._requestPage(-1)
+                    return
+                filelist = range(len(self._rows))
             else:
                 return
         
         filelist = sorted(filelist)
         files = []
         for f in filelist:
-            files.append(self._files[f])
+            files.append(self._documents.document(self._rows[f]))
         
         destination = None
         if doExport:
             conf = ConfigReader.get_instance()
             outfiledir = conf.getValue('outfiledir', '')
                         
-            outfilename = os.sep.join([outfiledir, 'Patientenakte_%d_%s_%s_%s-%s.pdf' % (int(self._infos["id"]), 
-                self._infos["name"], self._infos["surname"], self._infos["birthdate"], datetime.now().strftime('%Y%m%d%H%M%S'))])
+            outfilename = os.sep.join([outfiledir, 'Patientenakte_%d_%s_%s_%s-%s.pdf' % (int(self._displayedInfos["id"]), 
+                self._displayedInfos["name"], self._displayedInfos["surname"], self._displayedInfos["birthdate"], datetime.now().strftime('%Y%m%d%H%M%S'))])
             destination, _ = QFileDialog.getSaveFileName(self._av, "Auswahl als PDF exportieren", outfilename, "PDF-Datei (*.pdf)")
         if not doExport or len(destination) > 0:
             if doExport:
@@ -538,6 +760,7 @@ class ArchivTableModel(QAbstractTableModel):
                 self._av.taskbar_progress.setRange(0, len(filelist))
                 self._av.taskbar_progress.setValue(0)
                 self._av.taskbar_progress.show()
+            self._cancelPrerender()
             self._application.setOverrideCursor(Qt.WaitCursor)
             self._av.exportPdf.hide()
             self._av.cancelExport.show()
@@ -550,11 +773,12 @@ class ArchivTableModel(QAbstractTableModel):
             self._av.exportFileProgress.setEnabled(True)
             self._av.groupBox.setEnabled(False)
             
-            self._generateFileWorker = GenerateFileWorker(self._tmpdir, files, self._con, self._arccon, self._librepath, self._gimppath, self._gspath, exportDestination = destination)
+            self._generateFileWorker = GenerateFileWorker(self._tmpdir, files, self._pool, self._arcpool, self._librepath, self._gimppath, self._gspath, exportDestination = destination, office = self._office)
             self.generateFileThread = QThread()
             self._generateFileWorker.moveToThread(self.generateFileThread)
             self._generateFileWorker.kill.connect(self.generateFileThread.quit)
             self._generateFileWorker.progress.connect(self.generateFileProgress)
+            self._generateFileWorker.progressValue.connect(self.generateFileProgress)
             self._generateFileWorker.completed.connect(self.generateFileComplete)
             self._generateFileWorker.initGenerate.connect(self.generateFileStarted)
             self._generateFileWorker.initExport.connect(self.exportStarted)
@@ -566,29 +790,45 @@ class ArchivTableModel(QAbstractTableModel):
             self.generateFileThread.started.connect(self._generateFileWorker.work)
             self.generateFileThread.start()
 
-def readGDT(gdtfile):
-    grabinfo = {
-        3000: "id",
-        3101: "name",
-        3102: "surname",
-        3103: "birthdate"
-    }
+GDT_FIELDS = {
+    3000: "id",
+    3101: "name",
+    3102: "surname",
+    3103: "birthdate"
+}
+
+def gdtIdentity(infos):
+    return tuple(infos.get(field) for field in GDT_FIELDS.values())
+
+def parseGDT(lines):
     infos = {
         "id": None,
         "name": None,
         "surname": None
     }
-    with codecs.open(gdtfile, encoding="iso-8859-15", mode="r") as f:
-        for line in f:
+    found = set()
+    for line in lines:
+        if not line.endswith('\n'):
+            # last line of a file which is still being written
+            continue
+        try:
             linelen = int(line[:3])
             feldkennung = int(line[3:7])
-            inhalt = line[7:linelen - 2]
-            if feldkennung in grabinfo:
-                infos[grabinfo[feldkennung]] = inhalt
-                
+        except ValueError:
+            continue
+        inhalt = line[7:linelen - 2]
+        if feldkennung in GDT_FIELDS:
+            infos[GDT_FIELDS[feldkennung]] = inhalt
+            found.add(feldkennung)
+            if len(found) == len(GDT_FIELDS):
+                break
     
     return infos
 
+def readGDT(gdtfile):
+    with codecs.open(gdtfile, encoding="iso-8859-15", mode="r") as f:
+        return parseGDT(f)
+
 @contextmanager
 def tempdir(prefix='tmp'):
     """A context manager for creating and then deleting a temporary directory."""
@@ -718,8 +958,9 @@ def main():
     LOGGER.debug("DB Path is %s on %s" % (defaultDb, defaultHost))
     try:
         LOGGER.debug("Connecting db '{}' at '{}', port 2013 as user {}".format(defaultDb, defaultHost, defaultDbUser))
-        con = fdb.connect(host=defaultHost, database=defaultDb, port=2013,
+        connect = functools.partial(fdb.connect, host=defaultHost, database=defaultDb, port=2013,
             user=defaultDbUser, password=defaultDbPassword, fb_library_name=defaultClientLib)
+        con = connect()
         LOGGER.debug("Connection established.")
     except Exception as e:
         displayErrorMessage('Fehler beim Verbinden mit der Datenbank: {}. Pfad zur DLL-Datei: {}'.format(e, defaultClientLib))
@@ -727,8 +968,9 @@ def main():
         
     try:
         LOGGER.debug("Connecting archive db '{}' at '{}', port 2013 as user {}".format(defaultArcDb, defaultHost, defaultDbUser))
-        arccon = fdb.connect(host=defaultHost, database=defaultArcDb, port=2013,
+        arcconnect = functools.partial(fdb.connect, host=defaultHost, database=defaultArcDb, port=2013,
             user=defaultDbUser, password=defaultDbPassword, fb_library_name=defaultClientLib)
+        arccon = arcconnect()
         LOGGER.debug("Connection established.")
     except Exception as e:
         displayErrorMessage('Fehler beim Verbinden mit der Archivdatenbank: {}. Dieser Fehler kann bedenkenlos ignoriert werden, falls keine Archivdatenbank verfügbar ist (z.B. auf Mobilsystemen).'.format(e))
@@ -750,9 +992,24 @@ def main():
         displayErrorMessage("Fehler beim Feststellen des Exportpfades: {}".format(e))
         sys.exit()
         
+    # every thread checks out connections of its own, the ones opened above are the first ones in the pools
+    poolSize = config.getValue('dbPoolSize', 6)
+    pool = ConnectionPool('MEDOFF', connect, [ con ], maxSize = poolSize)
+    arcpool = None
+    if arccon is not None:
+        arcpool = ConnectionPool('MEDOFFARC', arcconnect, [ arccon ], maxSize = poolSize)
+        
+    office = None
+    prerenderOffice = None
+    if config.getValue('useOfficeService', True):
+        profiledir = os.sep.join([os.environ.get("LocalAppData", os.environ["AppData"]), "ArchivViewer"])
+        office = OfficeConverter.forLibreOffice(defaultLibrePath, profiledir)
+        # a service of its own, so that opening a document never waits for prerendering
+        prerenderOffice = OfficeConverter.forLibreOffice(defaultLibrePath, profiledir, name = 'soffice-prerender')
+        
     with tempdir() as myTemp:
-        av = ArchivViewer(con)        
-        tm = ArchivTableModel(con, arccon, myTemp, defaultLibrePath, av, app, gimppath, gspath)
+        av = ArchivViewer(pool)        
+        tm = ArchivTableModel(pool, arcpool, myTemp, defaultLibrePath, av, app, gimppath, gspath, office, prerenderOffice)
         av.documentView.doubleClicked.connect(lambda: tableDoubleClicked(av.documentView, tm))
         av.documentView.setModel(tm)
         av.actionStayOnTop.setChecked(config.getValue('stayontop', False))
@@ -784,6 +1041,7 @@ def main():
         
         try:
             infos = readGDT(gdtfile)
+            event_handler.setActivePatient(infos)
             tm.activePatientChanged.emit(infos)
         except Exception as e:
             displayErrorMessage("While loading GDT file: %s" % (e))
@@ -792,4 +1050,12 @@ def main():
         ret = app.exec_()
         observer.stop()
         observer.join()
+        event_handler.stop()
+        tm.shutdown()
+        for service in (office, prerenderOffice):
+            if service is not None:
+                service.stop()
+        pool.close()
+        if arcpool is not None:
+            arcpool.close()
     sys.exit(ret)
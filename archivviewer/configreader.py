@@ -1,12 +1,35 @@
 # configreader.py
 
-import os, json
+import os, json, atexit, copy, time, logging
 from contextlib import contextmanager
+from types import MappingProxyType
 import threading
 from PyQt5.QtCore import QMutex
 
+LOGGER = logging.getLogger(__name__)
+
+def _detached(value):
+    # the snapshot is only frozen at the top level, callers get their own copy
+    # of nested values so that changing them does not alter the snapshot
+    if isinstance(value, (dict, list, tuple)):
+        return copy.deepcopy(value)
+    return value
+
+class ConfigSnapshot:
+    """Frozen view of the configuration, e.g. for the duration of a worker job."""
+    def __init__(self, values):
+        self._values = values
+
+    def getValue(self, valName, default = None):
+        return _detached(self._values.get(valName, default))
+
 class ConfigReader:
+    """Reads are served from an immutable snapshot without locking. setValue
+    publishes a new snapshot and the file is written in the background, several
+    changes in quick succession result in a single write. Lists and dicts are
+    handed out as copies, changes to them only take effect through setValue."""
     __instance = None
+    _writeDelay = 0.5
 
     @staticmethod
     def get_instance():
@@ -21,43 +44,79 @@ class ConfigReader:
             raise Exception("This is a singleton class, don't instantiate it directly!")
         else:
             ConfigReader.__instance = self
-    
+
         self.dirconfpath = os.sep.join([os.environ["AppData"], "ArchivViewer", "config.json"])
-        self._config = {}
+        self._config = MappingProxyType({})
         self._mutex = QMutex(mode=QMutex.Recursive)
+        self._pending = threading.Condition()
+        self._dirty = False
+        self._writer = None
+        self._flushLock = threading.Lock()
         self.readConfig()
-    
+        atexit.register(self.writeConfig)
+
     @contextmanager
     def lock(self):
         self._mutex.lock()
-        yield
-        self._mutex.unlock()
-    
+        try:
+            yield
+        finally:
+            self._mutex.unlock()
+
     def readConfig(self):
         with self.lock():
             try:
                 with open(self.dirconfpath, "r") as f:
-                    self._config = json.load(f)
+                    self._config = MappingProxyType(json.load(f))
             except:
                 pass
-            
+
     def getValue(self, valName, default = None):
-        with self.lock():
-            try:
-                return self._config[valName]
-            except KeyError:
-                return default
-            
+        return _detached(self._config.get(valName, default))
+
+    def snapshot(self):
+        return ConfigSnapshot(self._config)
+
     def setValue(self, valName, val):
         with self.lock():
-            self._config[valName] = val
-            self._writeConfig()
-        
-    def _writeConfig(self):
+            config = dict(self._config)
+            config[valName] = copy.deepcopy(val)
+            self._config = MappingProxyType(config)
+        self._scheduleWrite()
+
+    def _scheduleWrite(self):
+        with self._pending:
+            self._dirty = True
+            if self._writer is None:
+                self._writer = threading.Thread(target = self._writeLoop, name = "ConfigWriter", daemon = True)
+                self._writer.start()
+            self._pending.notify()
+
+    def _writeLoop(self):
+        while True:
+            with self._pending:
+                while not self._dirty:
+                    self._pending.wait()
+            # collect further changes before writing
+            time.sleep(self._writeDelay)
+            try:
+                self.writeConfig()
+            except OSError as e:
+                LOGGER.info("Failed to write the configuration to '{}': {}".format(self.dirconfpath, e))
+
+    def _writeConfig(self, config):
         os.makedirs(os.path.dirname(self.dirconfpath), exist_ok = True)
-        with open(self.dirconfpath, "w") as f:
-            json.dump(self._config, f, indent = 1)
-            
+        tmppath = '{}.{}.part'.format(self.dirconfpath, os.getpid())
+        with open(tmppath, "w") as f:
+            json.dump(dict(config), f, indent = 1)
+        os.replace(tmppath, self.dirconfpath)
+
     def writeConfig(self):
-        with self.lock():
-            self._writeConfig()
\ No newline at end of file
+        """Writes pending changes right away."""
+        with self._flushLock:
+            with self._pending:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                config = self._config
+            self._writeConfig(config)
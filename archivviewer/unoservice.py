@@ -0,0 +1,77 @@
+# unoservice.py
+#
+# Conversion service for OfficeConverter. This script is not imported by Archiv Viewer but
+# runs on the Python interpreter shipped with LibreOffice, which provides the uno module.
+#
+# Usage: python unoservice.py <soffice> <profile url>
+
+import sys, os, json, time, subprocess
+import uno
+from com.sun.star.beans import PropertyValue
+from com.sun.star.connection import NoConnectException
+from com.sun.star.lang import DisposedException
+
+def prop(name, value):
+    p = PropertyValue()
+    p.Name = name
+    p.Value = value
+    return p
+
+def respond(**kwargs):
+    sys.stdout.write(json.dumps(kwargs) + '\n')
+    sys.stdout.flush()
+
+def connect(soffice, profile):
+    pipename = 'archivviewer_{}'.format(os.getpid())
+    office = subprocess.Popen([soffice, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+        '-env:UserInstallation={}'.format(profile), '--accept=pipe,name={};urp;StarOffice.ComponentContext'.format(pipename)])
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+    while True:
+        try:
+            ctx = resolver.resolve('uno:pipe,name={};urp;StarOffice.ComponentContext'.format(pipename))
+            break
+        except NoConnectException:
+            if office.poll() is not None:
+                sys.exit(1)
+            time.sleep(0.1)
+    desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+    
+    return (office, desktop)
+
+def convert(desktop, infile, outfile):
+    doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(infile), '_blank', 0, (prop('Hidden', True), prop('ReadOnly', True)))
+    if doc is None:
+        raise Exception("Dokument konnte nicht geladen werden")
+    try:
+        if doc.supportsService('com.sun.star.sheet.SpreadsheetDocument'):
+            pdffilter = 'calc_pdf_Export'
+        else:
+            pdffilter = 'writer_pdf_Export'
+        doc.storeToURL(uno.systemPathToFileUrl(outfile), (prop('FilterName', pdffilter),))
+    finally:
+        doc.close(True)
+
+def main():
+    office, desktop = connect(sys.argv[1], sys.argv[2])
+    respond(ready = True, pid = office.pid)
+    
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            convert(desktop, job['input'], job['output'])
+            respond(id = job['id'], ok = True)
+        except DisposedException:
+            # the office process is gone, let OfficeConverter restart us
+            sys.exit(1)
+        except Exception as e:
+            respond(id = job['id'], ok = False, error = str(e))
+    
+    try:
+        desktop.terminate()
+    except Exception:
+        pass
+    office.wait()
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-pyinstaller -w --add-binary archivviewer/icon128.png;archivviewer --add-data LICENSE.txt;. --icon resource/icon.ico --hidden-import libjpeg --hidden-import pylibjpeg ArchivViewer.py
\ No newline at end of file
+pyinstaller -w --add-binary archivviewer/icon128.png;archivviewer --add-data LICENSE.txt;. --add-data archivviewer/unoservice.py;archivviewer --icon resource/icon.ico --hidden-import libjpeg --hidden-import pylibjpeg ArchivViewer.py
\ No newline at end of file
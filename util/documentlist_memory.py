@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# Compares the memory used by the document list of a patient: one dict per row
+# (as before) against the column-wise DocumentList.
+#
+# usage: documentlist_memory.py [rows]
+
+import sys, os, random, tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archivviewer'))
+from DocumentList import DocumentList, dateLabel, timeLabel
+
+START_DATE = datetime(1890, 1, 1)
+
+def sample_rows(count):
+    random.seed(0)
+    words = [ 'Befund', 'Arztbrief', 'Labor', 'Röntgen', 'Überweisung', 'EKG', 'Sono', 'Rezept' ]
+    for i in range(count):
+        description = ' '.join(random.choice(words) for _ in range(random.randint(1, 4)))
+        yield (1000000 + i, description, random.randint(1, 40), random.randint(0, 86399), random.randint(40000, 48000), i % 7 == 0)
+
+def as_dicts(rows):
+    files = []
+    for (surogat, beschreibung, eintragsart, zeit, datum, medoffarc) in rows:
+        file = {
+            'id': surogat,
+            'datum': START_DATE + timedelta(days = datum, seconds = zeit),
+            'beschreibung': beschreibung,
+            'searchkey': beschreibung.lower(),
+            'category': eintragsart
+        }
+        if medoffarc:
+            file['medoffarc'] = True
+        files.append(file)
+    return files
+
+def as_documentlist(rows):
+    documents = DocumentList()
+    for row in rows:
+        documents.append(*row)
+    return documents
+
+def as_filtered_documentlist(rows):
+    documents = as_documentlist(rows)
+    documents.searchKeys()
+    return documents
+
+def measure(build, rows):
+    # the shared date and time labels count for every measurement
+    dateLabel.cache_clear()
+    timeLabel.cache_clear()
+    tracemalloc.start()
+    result = build(rows)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rows = list(sample_rows(count))
+
+    dicts = measure(as_dicts, rows)
+    columns = measure(as_documentlist, rows)
+    filtered = measure(as_filtered_documentlist, rows)
+    print("{} rows".format(count))
+    print("dicts:        {:>12,} bytes ({:.0f} per row)".format(dicts, dicts / count))
+    print("DocumentList: {:>12,} bytes ({:.0f} per row)".format(columns, columns / count))
+    print("  filtered:   {:>12,} bytes ({:.0f} per row, search keys built)".format(filtered, filtered / count))
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+# Compares the ways a JPEG scan can end up in a PDF: full decode and re-encode
+# with Pillow (the former behaviour), fitting to A4 with Pillow by decoding at
+# full size and resizing (the former behaviour) or with draft mode, and the
+# lossless img2pdf passthrough. Draft mode only scales by powers of two, it is
+# used when the scan is at least twice the A4 size, as in ArchiveConverter;
+# below that pil-draft-a4 is the same as pil-resize-a4, so the default sizes
+# cover both cases. Each variant runs in a process of its
+# own. Peak memory is the highest resident set size sampled during the
+# conversion minus the size right before it; Pillow's image buffers are not
+# visible to tracemalloc.
+#
+# usage: jpeg_benchmark.py [megapixels[,megapixels...]] [jpegfile]
+
+import sys, os, io, gc, time, threading, subprocess, tempfile
+from PIL import Image
+import img2pdf
+
+A4_PIXELS = (2480, 3508)
+
+def current_memory():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import ctypes
+        from ctypes import wintypes
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [ ('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD), ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t), ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t) ]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.WorkingSetSize
+
+class MemorySampler(threading.Thread):
+    """Records the highest resident set size while running. The process peak
+    (ru_maxrss) is useless here: importing img2pdf and its dependencies peaks
+    higher than decoding a scan into the memory freed afterwards."""
+    def __init__(self, interval = 0.001):
+        super().__init__(daemon = True)
+        self.interval = interval
+        self.peak = current_memory()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_memory())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_memory())
+
+def fit_size(size, bounds):
+    scale = min(bounds[0] / size[0], bounds[1] / size[1], 1)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+def pil_reencode(content):
+    img = Image.open(io.BytesIO(content))
+    img.load()
+    out = io.BytesIO()
+    img.save(out, 'PDF', resolution = 300)
+    return out.getvalue()
+
+def draft_size(size, bounds):
+    target = fit_size(size, bounds)
+    if size[0] >= 2 * target[0] and size[1] >= 2 * target[1]:
+        return target
+    return None
+
+def pil_resize_a4(content):
+    img = Image.open(io.BytesIO(content))
+    img.load()
+    img = img.resize(fit_size(img.size, A4_PIXELS), resample = Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, 'PDF', resolution = 300)
+    return out.getvalue()
+
+def pil_draft_a4(content):
+    img = Image.open(io.BytesIO(content))
+    if draft_size(img.size, A4_PIXELS) is not None:
+        img.draft(img.mode, draft_size(img.size, A4_PIXELS))
+    img.load()
+    img = img.resize(fit_size(img.size, A4_PIXELS), resample = Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, 'PDF', resolution = 300)
+    return out.getvalue()
+
+def img2pdf_passthrough(content):
+    layout_fun = img2pdf.get_fixed_dpi_layout_fun((300, 300))
+    return img2pdf.convert(content, layout_fun = layout_fun)
+
+VARIANTS = { 'pil-reencode': pil_reencode, 'pil-resize-a4': pil_resize_a4, 'pil-draft-a4': pil_draft_a4, 'img2pdf': img2pdf_passthrough }
+
+def sample_jpeg(path, megapixels):
+    width = int((megapixels * 1000000 * 2480 / 3508) ** 0.5)
+    height = int(width * 3508 / 2480)
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    img.save(path, 'JPEG', quality = 90)
+
+def run(variant, path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    gc.collect()
+    base = current_memory()
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.process_time()
+    pdf = VARIANTS[variant](content)
+    cpu = time.process_time() - start
+    sampler.stop()
+    print(cpu, sampler.peak - base, len(pdf))
+
+def measure(variant, path):
+    result = subprocess.run([ sys.executable, os.path.abspath(__file__), '--run', variant, path ], check = True, stdout = subprocess.PIPE, universal_newlines = True)
+    cpu, peak, size = result.stdout.split()
+    return float(cpu), int(peak), int(size)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    sizes = [ float(mp) for mp in sys.argv[1].split(',') ] if len(sys.argv) > 1 else [ 24, 48 ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for megapixels in sizes:
+            if len(sys.argv) > 2:
+                path = sys.argv[2]
+            else:
+                path = os.path.join(tmpdir, 'sample.jpg')
+                sample_jpeg(path, megapixels)
+            with Image.open(path) as img:
+                print("{}: {}x{} {}, {:.1f} MiB, draft mode {}".format(path, img.size[0], img.size[1], img.mode, os.path.getsize(path) / 1024 / 1024,
+                    'used' if draft_size(img.size, A4_PIXELS) is not None else 'not used'))
+            for variant in VARIANTS:
+                cpu, peak, size = measure(variant, path)
+                print("{:<14}{:>8.0f} ms CPU {:>8.1f} MiB peak {:>8.1f} MiB PDF".format(variant, cpu * 1000,
+                    peak / 1024 / 1024, size / 1024 / 1024))
+            if len(sys.argv) > 2:
+                break
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+# Runs archivviewer/PatientLoader.py against fake database connections and counts
+# the LTAG queries issued for the MEDOFFARC documents of a patient. Checks that
+# they are one per started block of 500 documents and page batch instead of one
+# per document, that no chunk exceeds 500 entries, that the documents without
+# LTAG entry are left out and that no LTAG query is made when removed items are
+# shown.
+#
+# usage: ltag_query_check.py [documents] [batchsize]
+
+import sys, os, types, math
+
+# the package __init__ starts the application, only the modules are needed here
+package = types.ModuleType('archivviewer')
+package.__path__ = [ os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archivviewer') ]
+sys.modules['archivviewer'] = package
+from archivviewer.PatientLoader import PatientLoader
+
+LTAG_CHUNK = 500
+
+class FakeCursor:
+    def __init__(self, con):
+        self._con = con
+        self._rows = []
+
+    def execute(self, stm, params):
+        if stm.startswith("SELECT l.FEINTRAGSNR"):
+            self._con.ltagQueries.append(len(params))
+            self._rows = [ (nr, self._con.category) for nr in params if nr in self._con.ltag ]
+        elif self._con.archive:
+            self._rows = list(self._con.documents)
+        else:
+            self._rows = []
+
+    def fetchmany(self, count):
+        rows = self._rows[:count]
+        self._rows = self._rows[count:]
+        return rows
+
+    def __iter__(self):
+        rows = self._rows
+        self._rows = []
+        return iter(rows)
+
+class FakeConnection:
+    category = 7
+
+    def __init__(self, documents = (), ltag = (), archive = False):
+        self.documents = documents
+        self.ltag = set(ltag)
+        self.archive = archive
+        self.ltagQueries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+class FakePool:
+    def __init__(self, con):
+        self._con = con
+
+    def acquire(self):
+        return self._con
+
+    def release(self, con, broken = False):
+        pass
+
+def check(count, batchSize, showRemovedItems):
+    documents = [ (100000 + i, 'Dokument {}'.format(i), FakeConnection.category, 3600, 45000 - i) for i in range(count) ]
+    # every seventh document has been removed in Medical Office
+    ltag = [ doc[0] for (i, doc) in enumerate(documents) if i % 7 != 0 ]
+    con = FakeConnection(ltag = ltag)
+    arccon = FakeConnection(documents, archive = True)
+
+    loader = PatientLoader(FakePool(con), FakePool(arccon), batchSize = batchSize)
+    loaded = []
+    loader.loaded.connect(lambda generation, infos, files, categoryIndex, hasMore: loaded.append(len(files)))
+    loader.fetched.connect(lambda generation, files, categoryIndex, hasMore: loaded.append(len(files)))
+    loader.failed.connect(lambda generation, message: print("load failed: {}".format(message)))
+    loader.setLatestGeneration(1)
+    loader.load(1, { 'id': '42' }, showRemovedItems, -1)
+
+    if showRemovedItems:
+        expectedQueries = 0
+        expectedDocuments = count
+    else:
+        batches = [ min(batchSize, count - start) for start in range(0, count, batchSize) ]
+        expectedQueries = sum(math.ceil(batch / LTAG_CHUNK) for batch in batches)
+        expectedDocuments = len(ltag)
+    queries = con.ltagQueries
+    ok = len(queries) == expectedQueries and all(n <= LTAG_CHUNK for n in queries) and sum(loaded) == expectedDocuments
+    print("{:>7} documents, batch {:>5}, removed {:<6} {:<5} {:>4} LTAG queries (expected {}), largest {:>4}, {} documents listed".format(
+        count, batchSize, 'shown' if showRemovedItems else 'hidden', 'ok' if ok else 'FAIL', len(queries), expectedQueries,
+        max(queries, default = 0), sum(loaded)))
+    return ok
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    batchSize = int(sys.argv[2]) if len(sys.argv) > 2 else 1200
+    results = [
+        check(count, batchSize, False),
+        check(count, 200, False),
+        check(1, batchSize, False),
+        check(count, batchSize, True),
+    ]
+    if not all(results):
+        sys.exit(1)
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+# Checks archivviewer/MemoParser.py against the slicing based FMEMO parser it
+# replaced (kept below as reference) on synthetic and randomly corrupted blobs,
+# then times both on a large synthetic blob. The category block length is a
+# 16 bit field, which limits a blob to roughly 700 categories.
+#
+# usage: memoparser_check.py [iterations] [categories]
+
+import sys, os, random, struct, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archivviewer'))
+from MemoParser import MOMask, parse_memo_blob
+
+def reference_parse_memo_blob(blob):
+    categories = {}
+    offset = 0
+    totallen = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    b1len = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2 + b1len
+    b2len = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2+ b2len
+    b3len = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2+ b3len
+    b4len = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2 + b4len
+    b5len = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2 + b5len
+    #b6len = int.from_bytes(blob[offset:offset+2], 'little')
+    #offset += 2 + b6len
+    categoriesLenRelative = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    categoriesLastOffset = categoriesLenRelative + offset
+    catCountLen = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    catCount = int.from_bytes(blob[offset:offset+catCountLen], 'little')
+    offset += catCountLen
+    while offset < categoriesLastOffset:
+        entryLen = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        category = reference_parse_memo_blob_category(blob[offset:offset+entryLen])
+        offset += entryLen
+        #if category['catType'] == "archive":
+        if category['useCategory']:
+            categories[category["id"]] = category
+        
+    return categories
+
+def reference_parse_memo_blob_category(blob):
+    offset = 0
+    name = None
+    keycode = None
+    red = None
+    blue = None
+    green = None
+    unknown2 = None
+    unknown3 = None
+    unknown4 = None
+    auftrag = None
+    unknown6 = None
+    key2 = None
+    useCategory = True
+    dayprotocol =  True
+    autosend = False
+    emergencysend = False
+    externalfile = False
+    catType = None
+    
+    b1len = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    b1 = blob[offset:offset+b1len]
+    offset += b1len
+    catidlen = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    catid = int.from_bytes(blob[offset:offset+catidlen], 'little')
+    offset += catidlen
+    kbtlen = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    kbt = blob[offset:offset+kbtlen-1].decode('cp1252')
+    offset += kbtlen
+    unklen5 = int.from_bytes(blob[offset:offset+2], 'little')
+    offset += 2
+    if unklen5 < 20:
+        if unklen5 > 0:
+            auftrag = blob[offset:offset+unklen5-1].decode('cp1252')
+            offset += unklen5
+        unklen3 = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        offset += unklen3
+        unklen4 = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        infobytes = blob[offset:offset+unklen4]
+        configbyte = 0b00000000
+        if len(infobytes) > 0:
+            configbyte = infobytes[0]
+        if configbyte & MOMask.NOTUSECATEGORY:
+            useCategory = False
+        if configbyte & MOMask.DAYPROTOCOL:
+            dayprotocol = False
+        if configbyte & MOMask.AUTOSEND:
+            autosend = True
+        if configbyte & MOMask.EMERGENCYSEND:
+            emergencysend = True
+        offset += unklen4
+        unklen6 = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        if unklen6 > 0:
+            unknown6 = int.from_bytes(blob[offset:offset+unklen6], 'little')
+            offset += unklen6
+        namelen = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        name = blob[offset:offset+namelen-1].decode('cp1252')
+        offset += namelen
+        key2len = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        if key2len > 0:
+            key2 = blob[offset:offset+key2len-1]
+            offset += key2len
+        else:
+            key2 = None
+        keycodelen = int.from_bytes(blob[offset:offset+2], 'little')
+        offset += 2
+        keycode = blob[offset:offset+keycodelen-1].decode('cp1252')
+        offset += keycodelen
+        if blob[offset:offset+2] == bytes.fromhex('0000'):
+            offset += 2
+            colorlen = int.from_bytes(blob[offset:offset+2], 'little')
+            offset += 2
+            if colorlen == 4:
+                red = blob[offset]
+                offset += 1
+                green = blob[offset]
+                offset += 1
+                blue = blob[offset]
+                offset += 2
+            else:
+                offset += colorlen
+        else:
+            red = None
+            green = None
+            blue = None       
+    
+    return { 'id': catid, 'krankenblatt': kbt,  'auftrag': auftrag,  'name': name, 'keycode': keycode, 'key2': key2, 'red': red, 'green': green, 
+                'blue': blue, 'useCategory': useCategory, 'dayProtocol': dayprotocol, 'autosend': autosend, 'emergencysend': emergencysend}
+
+def field(data):
+    return struct.pack('<H', len(data)) + data
+
+def text(value):
+    return field(value.encode('cp1252') + b'\x00')
+
+def sample_category(rnd, catid):
+    prefix = rnd.choice([ 'Bildarchiv', 'Externe Datei', 'Brief', 'Labor' ])
+    entry = field(bytes(rnd.randrange(256) for _ in range(rnd.randint(0, 6))))
+    entry += field(struct.pack('<H', catid))
+    entry += text('K{}'.format(catid))
+    entry += text('A{}'.format(rnd.randint(0, 99)))
+    entry += field(bytes(rnd.randint(0, 3)))
+    entry += field(bytes([ rnd.randrange(16) ]))
+    entry += field(struct.pack('<H', rnd.randrange(65536)))
+    entry += text('{} - Kategorie {} äöü'.format(prefix, catid))
+    entry += text('k2') if rnd.random() < 0.5 else field(b'')
+    entry += text('x{}'.format(catid % 10))
+    if rnd.random() < 0.8:
+        entry += b'\x00\x00' + field(bytes([ rnd.randrange(256) for _ in range(3) ]) + b'\x00')
+    return entry
+
+def sample_blob(rnd, count):
+    entries = b''.join(field(sample_category(rnd, catid)) for catid in range(1, count + 1))
+    categories = field(struct.pack('<H', count)) + entries
+    blob = b''.join(field(bytes(rnd.randint(0, 8))) for _ in range(5))
+    blob += struct.pack('<H', len(categories)) + categories
+    return struct.pack('<H', len(blob)) + blob
+
+def corrupt(rnd, blob):
+    blob = bytearray(blob)
+    for _ in range(rnd.randint(1, 4)):
+        action = rnd.random()
+        if action < 0.5 and len(blob) > 0:
+            blob[rnd.randrange(len(blob))] = rnd.randrange(256)
+        elif action < 0.8:
+            del blob[rnd.randrange(len(blob) + 1):]
+        else:
+            blob[rnd.randrange(len(blob) + 1):0] = bytes(rnd.randrange(256) for _ in range(rnd.randint(1, 4)))
+    return bytes(blob)
+
+def outcome(parser, blob):
+    try:
+        return parser(blob)
+    except Exception as e:
+        return type(e)
+
+def fuzz(iterations):
+    rnd = random.Random(0)
+    for i in range(iterations):
+        blob = sample_blob(rnd, rnd.randint(0, 20))
+        if i % 4 != 0:
+            blob = corrupt(rnd, blob)
+        expected = outcome(reference_parse_memo_blob, blob)
+        actual = outcome(parse_memo_blob, blob)
+        if expected != actual:
+            print("Mismatch for blob {}:\n  expected {}\n  got      {}".format(blob.hex(), expected, actual))
+            return False
+    print("{} blobs: results identical".format(iterations))
+    return True
+
+def benchmark(count):
+    blob = sample_blob(random.Random(1), count)
+    for (name, parser) in (('slicing', reference_parse_memo_blob), ('memoryview', parse_memo_blob)):
+        seconds = min(timeit.repeat(lambda: parser(blob), number = 5, repeat = 3)) / 5
+        print("{:<12}{} categories ({} bytes): {:.2f} ms".format(name, count, len(blob), seconds * 1000))
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    if not fuzz(iterations):
+        sys.exit(1)
+    benchmark(count)
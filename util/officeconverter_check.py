@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+# Runs archivviewer/OfficeConverter.py against a stub conversion service which
+# speaks the service protocol but decides by the content of the input file
+# whether to convert, hang or crash. Checks that timeouts and crashes are told
+# apart, that a per job timeout overrides the default one, that a crashed job is
+# retried once on a restarted service and that the service stays usable afterwards.
+# A service which never comes up is given up on after the first attempt.
+#
+# usage: officeconverter_check.py
+
+import sys, os, time, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archivviewer'))
+from OfficeConverter import OfficeConverter, OfficeConverterError, OfficeConverterTimeout, OfficeConverterUnavailable
+
+STUB_SERVICE = r'''
+import sys, os, json, time
+print(json.dumps({ 'ready': True, 'pid': None }), flush = True)
+for line in sys.stdin:
+    job = json.loads(line)
+    with open(job['input'], 'rb') as f:
+        action = f.read().decode()
+    if action == 'hang':
+        time.sleep(3600)
+    elif action == 'crash' or (action == 'crash-once' and not os.path.exists(job['input'] + '.crashed')):
+        open(job['input'] + '.crashed', 'w').close()
+        os._exit(1)
+    with open(job['output'], 'wb') as f:
+        f.write(b'%PDF-1.4 stub')
+    print(json.dumps({ 'id': job['id'], 'ok': True, 'error': None }), flush = True)
+'''
+
+def job(tmpdir, name, action):
+    infile = os.path.join(tmpdir, name + '.rtf')
+    with open(infile, 'wb') as f:
+        f.write(action.encode())
+    return infile, os.path.join(tmpdir, name + '.pdf')
+
+def expect(converter, infile, outfile, error = None, errorType = OfficeConverterError, timeout = None):
+    start = time.monotonic()
+    try:
+        converter.convert(infile, outfile, timeout = timeout)
+        result = None
+    except OfficeConverterError as e:
+        result = str(e)
+        ok = isinstance(e, errorType)
+    elapsed = time.monotonic() - start
+    if error is None:
+        ok = result is None and os.path.isfile(outfile)
+    else:
+        ok = result is not None and ok and error in result and (timeout is None or elapsed < timeout + 1)
+    print("{:<16}{:<6}{:>6.1f} s  {}".format(os.path.basename(infile), 'ok' if ok else 'FAIL', elapsed, result or 'converted'))
+    return ok
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmpdir:
+        script = os.path.join(tmpdir, 'stubservice.py')
+        with open(script, 'w') as f:
+            f.write(STUB_SERVICE)
+        converter = OfficeConverter([ sys.executable, script ], startTimeout = 10, jobTimeout = 2)
+        results = [
+            expect(converter, *job(tmpdir, 'plain', 'convert')),
+            expect(converter, *job(tmpdir, 'hang', 'hang'), error = 'Zeitüberschreitung', errorType = OfficeConverterTimeout),
+            expect(converter, *job(tmpdir, 'hangshort', 'hang'), error = 'Zeitüberschreitung', errorType = OfficeConverterTimeout, timeout = 0.5),
+            expect(converter, *job(tmpdir, 'crashonce', 'crash-once')),
+            expect(converter, *job(tmpdir, 'crash', 'crash'), error = 'wiederholt abgestürzt'),
+            expect(converter, *job(tmpdir, 'after', 'convert')),
+        ]
+        converter.stop()
+        # exits right away instead of announcing itself
+        broken = OfficeConverter([ sys.executable, '-c', 'pass' ], startTimeout = 10, jobTimeout = 2)
+        results.extend([
+            expect(broken, *job(tmpdir, 'nostart', 'convert'), error = 'nicht gestartet', errorType = OfficeConverterUnavailable),
+            expect(broken, *job(tmpdir, 'nostart2', 'convert'), error = 'nicht verfügbar', errorType = OfficeConverterUnavailable),
+        ])
+        results.append(not broken.available())
+    if not all(results):
+        sys.exit(1)